@@ -0,0 +1,177 @@
+# Copyright (c) 2010-2011, Kundan Singh. All rights reserved. see README for details.
+
+'''
+Micro-benchmarks for the hot paths of the rtmp and multitask modules. Each benchmark runs on the local host without any
+Flash Player and prints a single line of result, so that the numbers can be compared before and after a change.
+
+To list the available benchmarks use the -h option:
+$ python benchmark.py -h
+
+To run the parse benchmark which feeds Protocol.parseMessages a 10 seconds long 5 Mbit/s audio+video stream:
+$ python benchmark.py parse
+
+To run the write benchmark which counts the socket sends needed by Protocol.write to deliver the same stream to a player:
+$ python benchmark.py write
+
+To run the header benchmark which measures the per-chunk cost of encoding chunk headers of the same stream:
+$ python benchmark.py header
+
+To run the overhead benchmark which counts the chunk header bytes added by Protocol.writeChunks to the same stream:
+$ python benchmark.py overhead
+
+To run the timers benchmark which measures the CPU cost of 10000 concurrent tasks pacing with sleep(), each paired with
+a task waiting on a queue with timeout as done by players and publishers:
+$ python benchmark.py -n 10000 timers
+'''
+
+import time, socket, struct, multitask
+from rtmp import Header, Message, Protocol, ConnectionClosed
+
+def mediastream(duration=10, bitrate=5000000, fps=30, gop=2):
+    '''Return a list of (type, time, size) for a publisher's audio and video at the given bitrate. Audio is 128 kbit/s AAC with
+    one frame every 23 ms, video has a keyframe every gop seconds which is ten times the size of an inter frame.'''
+    audio, video = 128000/8*23/1000, (bitrate - 128000)/8 * gop / (fps*gop + 9)
+    result = [(Message.AUDIO, t, audio) for t in xrange(0, duration*1000, 23)]
+    result += [(Message.VIDEO, i*1000/fps, video*10 if i % (fps*gop) == 0 else video) for i in xrange(duration*fps)]
+    return sorted(result, key=lambda x: x[1])
+
+def chunked(messages, chunkSize=Protocol.DEFAULT_CHUNK_SIZE):
+    '''Return the wire bytes of the given (type, time, size) messages as sent by a publisher on stream id 1, using type-0
+    header for the first message on a chunk stream and type-1 header with timestamp delta for others. A set chunk size
+    message is sent first if chunkSize is not the default.'''
+    output, last = [], {}
+    if chunkSize != Protocol.DEFAULT_CHUNK_SIZE: # tell the receiver about the chunk size first
+        output.append(Header(channel=Protocol.PROTOCOL_CHANNEL_ID, time=0, size=4, type=Message.CHUNK_SIZE).toBytes(Header.FULL) + struct.pack('>L', chunkSize))
+    for type, tm, size in messages:
+        channel = 4 if type == Message.AUDIO else 5
+        control = Header.MESSAGE if channel in last else Header.FULL
+        hdr = Header(channel=channel, time=tm - last[channel] if channel in last else tm, size=size, type=type, streamId=1)
+        last[channel], data = tm, '\x00' * size
+        for i in xrange(0, size, chunkSize):
+            output.append(hdr.toBytes(control)); output.append(data[i:i+chunkSize])
+            control = Header.SEPARATOR
+    return ''.join(output)
+
+def parse(duration=10, bitrate=5000000, chunkSize=Protocol.DEFAULT_CHUNK_SIZE, **kwargs):
+    '''Feed Protocol.parseMessages with a publisher stream over a socket pair, and measure the time to parse all the messages.'''
+    messages = mediastream(duration, bitrate)
+    data = chunked(messages, chunkSize)
+    sock1, sock2 = socket.socketpair()
+    class Counter(Protocol):
+        count = 0
+        def messageReceived(self, msg):
+            self.count += 1
+            yield
+    protocol = Counter(sock2)
+    def writer():
+        for i in xrange(0, len(data), 65536):
+            yield _sendall(sock1, data[i:i+65536])
+        sock1.close()
+    def reader():
+        try: yield protocol.parseMessages()
+        except ConnectionClosed: pass
+    multitask.add(writer()); multitask.add(reader())
+    start = time.time()
+    multitask.run()
+    elapsed = time.time() - start
+    print 'parse: %d messages, %d bytes of %d kbit/s stream in %.3f s (%.1fx realtime, chunk size %d)'%(protocol.count, len(data), bitrate/1000, elapsed, duration/elapsed, chunkSize)
+    assert protocol.count == len(messages)
+
+def write(duration=10, bitrate=5000000, **kwargs):
+    '''Queue a player's audio and video messages in Protocol.writeQueue in bursts of 40 ms each, as they arrive from a
+    publisher, and count the socket sends and time needed by Protocol.write to deliver them over a socket pair.'''
+    messages = mediastream(duration, bitrate)
+    sock1, sock2 = socket.socketpair()
+    class Counter(object): # socket wrapper that counts the send calls
+        sends = 0
+        def fileno(self): return sock1.fileno()
+        def setblocking(self, flag): sock1.setblocking(flag)
+        def close(self): sock1.close()
+        def send(self, data):
+            self.sends += 1
+            return sock1.send(data)
+    counter = Counter()
+    protocol, total = Protocol(counter), sum([x[2] for x in messages])
+    def feeder():
+        for i in xrange(0, duration*1000, 40):
+            for type, tm, size in [x for x in messages if i <= x[1] < i+40]:
+                msg = Message(); msg.type, msg.time, msg.streamId, msg.data = type, tm, 1, '\x00' * size
+                yield protocol.writeMessage(msg)
+            yield multitask.sleep(0.001) # let the event loop go through select between bursts
+        yield protocol.writeMessage(None)
+    def reader():
+        while (yield multitask.recv(sock2, 262144)): pass
+    multitask.add(protocol.write()); multitask.add(feeder()); multitask.add(reader())
+    start = time.time()
+    multitask.run()
+    elapsed = time.time() - start
+    print 'write: %d messages, %d bytes in %d socket sends, %.3f s (chunk size %d)'%(len(messages), total, counter.sends, elapsed, protocol.writeChunkSize)
+
+def header(duration=10, bitrate=5000000, chunkSize=Protocol.DEFAULT_CHUNK_SIZE, **kwargs):
+    '''Measure the cost of Header.toBytes for every chunk header of the stream, a type-1 header for the first chunk of
+    a message followed by type-3 headers for the rest, and the creation of Header objects as done in parseMessages.'''
+    messages, repeat = mediastream(duration, bitrate), 5
+    headers = [(Header(channel=4 if type == Message.AUDIO else 5, time=33, size=size, type=type, streamId=1), (size + chunkSize - 1) / chunkSize) for type, tm, size in messages]
+    count = sum([x[1] for x in headers]) * repeat
+    start = time.time()
+    for i in xrange(repeat):
+        for hdr, chunks in headers:
+            hdr.toBytes(Header.MESSAGE)
+            for j in xrange(chunks - 1): hdr.toBytes(Header.SEPARATOR)
+    elapsed = time.time() - start
+    start = time.time()
+    for i in xrange(count): Header(5)
+    created = time.time() - start
+    print 'header: %d chunk headers encoded in %.3f s (%.0f ns per chunk), Header() takes %.0f ns'%(count, elapsed, elapsed*1e9/count, created*1e9/count)
+
+def overhead(duration=10, bitrate=5000000, chunkSize=Protocol.DEFAULT_CHUNK_SIZE, **kwargs):
+    '''Chunk a player's audio and video messages with Protocol.writeChunks as sent on one stream, and count the bytes of
+    chunk headers in the output, i.e., beyond the media payload.'''
+    messages = mediastream(duration, bitrate)
+    sock1, sock2 = socket.socketpair()
+    protocol, output = Protocol(sock1), bytearray()
+    protocol.writeChunkSize = chunkSize
+    for type, tm, size in messages:
+        msg = Message(); msg.type, msg.time, msg.streamId, msg.data = type, tm, 1, '\x00' * size
+        protocol.writeChunks(msg, output)
+    payload = sum([x[2] for x in messages])
+    print 'overhead: %d messages, %d payload bytes, %d chunk header bytes (%.2f bytes per message, chunk size %d)'%(len(messages), payload, len(output) - payload, float(len(output) - payload)/len(messages), chunkSize)
+
+def timers(duration=10, count=10000, **kwargs):
+    '''Run count sleeper tasks that sleep between 20 and 69 ms in a loop for duration seconds, each putting an item in a
+    queue after waking up, and count consumer tasks that get from those queues with a timeout of 60 seconds, so that every
+    wake up also cancels a pending timeout. Measure the CPU time per wake up.'''
+    wakeups, end = [0], time.time() + duration
+    def sleeper(queue, interval):
+        while time.time() < end:
+            yield multitask.sleep(interval)
+            wakeups[0] += 1
+            yield queue.put(True)
+        yield queue.put(None)
+    def consumer(queue):
+        while (yield queue.get(timeout=60)): pass
+    for i in xrange(count):
+        queue = multitask.Queue()
+        multitask.add(sleeper(queue, 0.020 + (i % 50) * 0.001)); multitask.add(consumer(queue))
+    start, cpu = time.time(), time.clock()
+    multitask.run()
+    elapsed, cpu = time.time() - start, time.clock() - cpu
+    print 'timers: %d sleepers, %d wake ups in %.3f s, %.3f s CPU (%.1f us per wake up)'%(count, wakeups[0], elapsed, cpu, cpu*1e6/wakeups[0])
+
+def _sendall(sock, data):
+    while data:
+        sent = (yield multitask.send(sock, data))
+        data = data[sent:]
+
+benchmarks = dict(parse=parse, write=write, header=header, overhead=overhead, timers=timers)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage='usage: %prog [options] ' + '|'.join(sorted(benchmarks.keys())))
+    parser.add_option('-t', '--duration', dest='duration', default=10, type='int', help='seconds of media to use in parse benchmark. Default 10')
+    parser.add_option('-b', '--bitrate', dest='bitrate', default=5000000, type='int', help='bits per second of media in parse benchmark. Default 5000000')
+    parser.add_option('-c', '--chunk-size', dest='chunkSize', default=Protocol.DEFAULT_CHUNK_SIZE, type='int', help='RTMP chunk size used by publisher. Default 128')
+    parser.add_option('-n', '--count', dest='count', default=10000, type='int', help='number of concurrent sleepers in timers benchmark. Default 10000')
+    (options, args) = parser.parse_args()
+    for name in (args or sorted(benchmarks.keys())):
+        benchmarks[name](**options.__dict__)
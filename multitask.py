@@ -137,6 +137,7 @@ import collections
 import errno
 from functools import partial
 import heapq
+import math
 import os
 import select
 import sys
@@ -296,6 +297,7 @@ class FDReady(YieldCondition):
         super(FDReady, self).__init__(timeout)
 
         self.fd = (fd if _is_file_descriptor(fd) else fd.fileno())
+        self._file = fd
 
         if not (read or write or exc):
             raise ValueError("'read', 'write', and 'exc' cannot all be false")
@@ -402,9 +404,17 @@ class FDAction(FDReady):
         Timeout exception will be raised in the yielding task if fd is
         not ready after timeout seconds have elapsed.
 
+        If kwargs contains a true optimistic argument, the task
+        manager calls func right away, and waits for fd to be ready
+        only if func fails with EAGAIN or EWOULDBLOCK.  This saves a
+        poll for every send on a socket with free send buffer and
+        every recv on a socket with pending data, but requires that fd
+        is in non-blocking mode.
+
         """
 
         timeout = kwargs.pop('timeout', None)
+        self.optimistic = kwargs.pop('optimistic', False)
         super(FDAction, self).__init__(fd, read, write, exc, timeout)
 
         self.func = func
@@ -522,6 +532,27 @@ def recv(sock, *args, **kwargs):
     return FDAction(sock, sock.recv, args, kwargs, read=True)
 
 
+def recv_into(sock, *args, **kwargs):
+    """
+
+    A task that yields the result of this function will be resumed
+    when sock is readable, and the value of the yield expression will
+    be the number of bytes received from sock into the supplied
+    buffer.  If a timeout keyword is given and is not None, a Timeout
+    exception will be raised in the yielding task if sock is not
+    readable after timeout seconds have elapsed.  Other arguments will
+    be passed to sock.recv_into().  For example:
+
+      try:
+          nbytes = (yield recv_into(sock, buffer, 1024, timeout=5))
+      except Timeout:
+          # No data after 5 seconds
+
+    """
+
+    return FDAction(sock, sock.recv_into, args, kwargs, read=True)
+
+
 def recvfrom(sock, *args, **kwargs):
     """
 
@@ -803,6 +834,428 @@ class _SmartQueueAction(YieldCondition):
         self.expires = (timeout is not None) and (time.time() + timeout) or 0
 
 
+################################################################################
+#
+# Poller classes
+#
+################################################################################
+
+
+
+class SelectPoller(object):
+
+    """
+
+    Poller that passes the complete read, write and exc wait sets to
+    select() on every call.  This is O(n) per call and limited to
+    FD_SETSIZE descriptors, hence is used only on platforms that have
+    neither epoll() nor poll().
+
+    """
+
+    def __init__(self):
+        self._read_waits  = set()
+        self._write_waits = set()
+        self._exc_waits   = set()
+
+    def __nonzero__(self):
+        return bool(self._read_waits or self._write_waits or self._exc_waits)
+
+    def waiters(self):
+        'Return the FDReady instances currently waiting for I/O'
+        return list(self._read_waits | self._write_waits | self._exc_waits)
+
+    def register(self, waiter):
+        'Start waiting for the I/O readiness requested by the FDReady instance'
+        waiter._add_to_fdsets(self._read_waits,
+                              self._write_waits,
+                              self._exc_waits)
+
+    def unregister(self, waiter):
+        'Stop waiting for the FDReady instance, if it is still waiting'
+        waiter._remove_from_fdsets(self._read_waits,
+                                   self._write_waits,
+                                   self._exc_waits)
+
+    def merge(self, other):
+        'Move all the waiters of another poller to this one'
+        for waiter in other.waiters():
+            self.register(waiter)
+
+    def forget(self, fd):
+        'Drop the waiters of a file descriptor that is about to be closed'
+        for waiter in self.waiters():
+            if waiter.fd == fd:
+                self.unregister(waiter)
+
+    def poll(self, timeout):
+        """
+
+        Wait for at most timeout seconds (or indefinitely if timeout
+        is None) and return a tuple (ready, bad).  ready is the list
+        of waiters whose I/O readiness is satisfied, or None if the
+        call should be retried, and bad is the list of waiters that
+        were dropped because of an invalid file descriptor.
+
+        """
+
+        # The error handling here is (mostly) borrowed from Twisted
+        try:
+            read_ready, write_ready, exc_ready = \
+                select.select(self._read_waits,
+                              self._write_waits,
+                              self._exc_waits,
+                              timeout)
+        except (TypeError, ValueError):
+            return None, self._remove_bad_file_descriptors()
+        except (select.error, IOError), err:
+            if err[0] == errno.EINTR:
+                return None, []
+            elif ((err[0] == errno.EBADF) or
+                  ((sys.platform == 'win32') and
+                   (err[0] == 10038))):  # WSAENOTSOCK
+                return None, self._remove_bad_file_descriptors()
+            else:
+                # Not an error we can handle, so die
+                raise
+        else:
+            return list(set(read_ready + write_ready + exc_ready)), []
+
+    def _remove_bad_file_descriptors(self):
+        bad = []
+        for fd in self.waiters():
+            try:
+                select.select([fd], [fd], [fd], 0.0)
+            except:
+                # TODO: do not enqueue the exception (socket.error) so that it does not crash
+                # when closing an already closed socket. See rtmplite issue #28
+                # self._enqueue(fd.task, exc_info=sys.exc_info())
+                self.unregister(fd)
+                bad.append(fd)
+        return bad
+
+
+class _MaskPoller(object):
+
+    """
+
+    Base class of pollers that keep a persistent registration of file
+    descriptor and event mask with the kernel.  Waiters are kept per
+    file descriptor, and the registration is updated only before the
+    next poll and only if the combined event mask of the waiters has
+    changed.  Thus a task that waits again on the same socket after
+    its I/O operation completes does not cost any extra system call.
+
+    Unlike select(), the kernel does not report an error for a file
+    descriptor that is closed while a task waits on it.  Such waiters
+    are dropped, as SelectPoller does on EBADF, when the descriptor
+    number is waited on through another object (i.e. it was re-used),
+    or by a check of all the waited descriptors every CHECK_INTERVAL
+    seconds.
+
+    Since the registration is removed lazily, a file descriptor that
+    may still be open elsewhere when it is closed here (e.g. after
+    fork(), dup() or passing it to another process) must be given to
+    forget() before it is closed.  Otherwise an epoll registration of
+    the open file outlives the descriptor number, and wakes up the
+    waiters of another file that re-uses the number.
+
+    """
+
+    READ = WRITE = EXC = ERROR = INVALID = 0 # event masks defined by the sub-class
+    CHECK_INTERVAL = 1.0 # seconds between checks for closed file descriptors
+
+    def __init__(self):
+        self._waits      = {}    # file descriptor => list of waiters
+        self._registered = {}    # file descriptor => registered event mask
+        self._files      = {}    # file descriptor => object last waited on
+        self._changed    = set() # file descriptors whose waiters changed since the last poll
+        self._bad        = []    # waiters dropped since the last poll
+        self._checked    = time.time()
+
+    def __nonzero__(self):
+        return bool(self._waits)
+
+    def waiters(self):
+        'Return the FDReady instances currently waiting for I/O'
+        return [waiter for waits in self._waits.itervalues() for waiter in waits]
+
+    def register(self, waiter):
+        'Start waiting for the I/O readiness requested by the FDReady instance'
+        fd = waiter.fd
+        if self._files.get(fd, waiter._file) != waiter._file:
+            # previous object was closed and its descriptor re-used
+            self._registered.pop(fd, None)
+            self._bad.extend(self._waits.pop(fd, ()))
+        self._files[fd] = waiter._file
+        self._waits.setdefault(fd, []).append(waiter)
+        self._changed.add(fd)
+
+    def unregister(self, waiter):
+        'Stop waiting for the FDReady instance, if it is still waiting'
+        waits = self._waits.get(waiter.fd)
+        if waits and waiter in waits:
+            waits.remove(waiter)
+            if not waits:
+                del self._waits[waiter.fd]
+            self._changed.add(waiter.fd)
+
+    def merge(self, other):
+        'Move all the waiters of another poller to this one'
+        for waiter in other.waiters():
+            self.register(waiter)
+
+    def forget(self, fd):
+        'Drop the waiters and the registration of a file descriptor that is about to be closed'
+        self._bad.extend(self._waits.pop(fd, ()))
+        self._files.pop(fd, None)
+        self._changed.discard(fd)
+        if fd in self._registered:
+            try:
+                self._update(fd, 0)
+            except (IOError, OSError, ValueError):
+                self._registered.pop(fd, None)
+
+    def poll(self, timeout):
+        """
+
+        Wait for at most timeout seconds (or indefinitely if timeout
+        is None) and return a tuple (ready, bad) as described in
+        SelectPoller.poll().
+
+        """
+
+        bad, ready, self._bad = self._bad, [], []
+        if time.time() - self._checked >= self.CHECK_INTERVAL:
+            self._checked = time.time()
+            for fd in self._waits.keys():
+                try:
+                    os.fstat(fd)
+                except OSError:
+                    bad.extend(self._waits.pop(fd))
+                    self._changed.add(fd)
+        changed, self._changed = self._changed, set()
+        for fd in changed:
+            mask = 0
+            for waiter in self._waits.get(fd, ()):
+                mask |= ((waiter.read and self.READ) | (waiter.write and self.WRITE) |
+                         (waiter.exc and self.EXC))
+            if not mask:
+                self._files.pop(fd, None)
+            if mask != self._registered.get(fd, 0):
+                try:
+                    self._update(fd, mask)
+                except (IOError, OSError, ValueError):
+                    self._registered.pop(fd, None)
+                    self._files.pop(fd, None)
+                    bad.extend(self._waits.pop(fd, ()))
+        if not self._waits:
+            return None, bad
+        if (timeout is None) or (timeout > self.CHECK_INTERVAL):
+            timeout = self.CHECK_INTERVAL
+        try:
+            events = self._poll(timeout)
+        except (select.error, IOError), err:
+            if err[0] == errno.EINTR:
+                return None, bad
+            raise
+        for fd, event in events:
+            waits = self._waits.get(fd)
+            if not waits:
+                continue
+            if event & self.INVALID:
+                bad.extend(self._waits.pop(fd))
+                self._changed.add(fd)
+                continue
+            for waiter in waits:
+                if ((event & self.ERROR) or (waiter.read and event & self.READ) or
+                    (waiter.write and event & self.WRITE) or (waiter.exc and event & self.EXC)):
+                    ready.append(waiter)
+        return ready, bad
+
+
+class PollPoller(_MaskPoller):
+
+    'Poller that uses poll(), which is not limited to FD_SETSIZE descriptors'
+
+    READ, WRITE, EXC = 0x001, 0x004, 0x002 # POLLIN, POLLOUT, POLLPRI
+    ERROR, INVALID = 0x008 | 0x010, 0x020  # POLLERR | POLLHUP, POLLNVAL
+
+    def __init__(self):
+        super(PollPoller, self).__init__()
+        self._poller = select.poll()
+
+    def _update(self, fd, mask):
+        if mask:
+            self._poller.register(fd, mask) # also modifies an existing registration
+            self._registered[fd] = mask
+        else:
+            del self._registered[fd]
+            try:
+                self._poller.unregister(fd)
+            except KeyError:
+                pass
+
+    def _poll(self, timeout):
+        return self._poller.poll(None if timeout is None else int(math.ceil(timeout * 1000)))
+
+
+class EPollPoller(_MaskPoller):
+
+    """
+
+    Poller that uses Linux epoll(), for which the cost of a call
+    depends only on the number of ready file descriptors.  The kernel
+    removes a file from the epoll set only when its last descriptor
+    is closed, in any process, hence a descriptor that is shared with
+    another process must be given to forget() before it is closed.
+
+    """
+
+    READ, WRITE, EXC = 0x001, 0x004, 0x002 # EPOLLIN, EPOLLOUT, EPOLLPRI
+    ERROR, INVALID = 0x008 | 0x010, 0      # EPOLLERR | EPOLLHUP
+
+    def __init__(self):
+        super(EPollPoller, self).__init__()
+        self._poller = select.epoll()
+
+    def _update(self, fd, mask):
+        if mask:
+            try:
+                if fd in self._registered:
+                    self._poller.modify(fd, mask)
+                else:
+                    self._poller.register(fd, mask)
+            except IOError, err:
+                if err[0] == errno.ENOENT:   # closed and re-used file descriptor
+                    self._poller.register(fd, mask)
+                elif err[0] == errno.EEXIST:
+                    self._poller.modify(fd, mask)
+                else:
+                    raise
+            self._registered[fd] = mask
+        else:
+            del self._registered[fd]
+            try:
+                self._poller.unregister(fd)
+            except (IOError, OSError):
+                pass # already closed, and the file not open elsewhere unless forget() was missed
+
+    def _poll(self, timeout):
+        return self._poller.poll(-1 if timeout is None else timeout)
+
+
+def default_poller():
+    """
+
+    Return a new instance of the best poller available on this
+    platform: EPollPoller on Linux, PollPoller where poll() exists,
+    and SelectPoller otherwise.
+
+    """
+
+    if hasattr(select, 'epoll'):
+        return EPollPoller()
+    elif hasattr(select, 'poll'):
+        return PollPoller()
+    return SelectPoller()
+
+
+
+################################################################################
+#
+# _TimeoutBuckets class
+#
+################################################################################
+
+
+
+class _TimeoutBuckets(object):
+
+    """
+
+    Pending timeouts of a TaskManager, grouped in buckets of
+    granularity seconds.  The heap holds one bucket number per bucket
+    instead of one entry per timeout, so adding a timeout to an
+    existing bucket is O(1), as is removing a timeout, which only
+    drops it from the set of pending items.  A removed item is skipped
+    when its bucket expires, and the buckets are compacted when the
+    removed items outnumber the pending ones.
+
+    """
+
+    def __init__(self, granularity):
+        self.granularity = float(granularity)
+        self._heap    = []    # bucket numbers
+        self._buckets = {}    # bucket number => deque of items
+        self._pending = set()
+        self._entries = 0     # items in all the buckets, including removed ones
+
+    def __nonzero__(self):
+        return bool(self._pending)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, item):
+        number = int(math.ceil(item.expiration / self.granularity))
+        bucket = self._buckets.get(number)
+        if bucket is None:
+            self._buckets[number] = collections.deque((item,))
+            heapq.heappush(self._heap, number)
+        else:
+            bucket.append(item)
+        self._pending.add(item)
+        self._entries += 1
+
+    def remove(self, item):
+        self._pending.discard(item)
+        if self._entries > 2 * len(self._pending) + 1024:
+            self._compact()
+
+    def merge(self, other):
+        for item in other._pending:
+            self.add(item)
+
+    def next_expiration(self):
+        'Return the expiration time of the first bucket with a pending item, or None'
+        heap, buckets, pending = self._heap, self._buckets, self._pending
+        while heap:
+            bucket = buckets[heap[0]]
+            while bucket and bucket[0] not in pending:
+                bucket.popleft()
+                self._entries -= 1
+            if bucket:
+                return heap[0] * self.granularity
+            del buckets[heapq.heappop(heap)]
+        return None
+
+    def expired(self, current_time):
+        'Remove and return the pending items of all the buckets that expired by current_time'
+        heap, buckets, pending, result = self._heap, self._buckets, self._pending, []
+        while heap and heap[0] * self.granularity <= current_time:
+            bucket = buckets.pop(heapq.heappop(heap))
+            self._entries -= len(bucket)
+            for item in bucket:
+                if item in pending:
+                    pending.remove(item)
+                    result.append(item)
+        return result
+
+    def _compact(self):
+        pending = self._pending
+        for number, bucket in self._buckets.items():
+            items = [item for item in bucket if item in pending]
+            if items:
+                self._buckets[number] = collections.deque(items)
+            else:
+                del self._buckets[number]
+        self._heap = self._buckets.keys()
+        heapq.heapify(self._heap)
+        self._entries = sum(map(len, self._buckets.itervalues()))
+
+
+
 ################################################################################
 #
 # TaskManager class
@@ -820,7 +1273,9 @@ class TaskManager(object):
 
     """
 
-    def __init__(self):
+    OPTIMISTIC_LIMIT = 256 # optimistic I/O attempts per run cycle
+
+    def __init__(self, poller=None, granularity=0.001):
         """
 
         Create a new TaskManager instance.  Generally, there will only
@@ -828,14 +1283,21 @@ class TaskManager(object):
         existing instances simultaneously, merge them first, then run
         one or the other.
 
+        If poller is None, the best poller available on the platform
+        is used to wait for I/O (see default_poller()).  Otherwise it
+        must be a new instance of SelectPoller, PollPoller or
+        EPollPoller.
+
+        Timeouts, including sleep(), expire at the next multiple of
+        granularity seconds at or after their expiration time.
+
         """
 
         self._queue       = collections.deque()
-        self._read_waits  = set()
-        self._write_waits = set()
-        self._exc_waits   = set()
+        self._poller      = poller or default_poller()
         self._queue_waits = collections.defaultdict(self._double_deque)
-        self._timeouts    = []
+        self._timeouts    = _TimeoutBuckets(granularity)
+        self._optimistic  = 0 # optimistic I/O attempts left in this run cycle
 
     @staticmethod
     def _double_deque():
@@ -855,20 +1317,15 @@ class TaskManager(object):
 
         # Merge the data structures
         self._queue.extend(other._queue)
-        self._read_waits  |= other._read_waits
-        self._write_waits |= other._write_waits
-        self._exc_waits   |= other._exc_waits
+        self._poller.merge(other._poller)
         self._queue_waits.update(other._queue_waits)
-        self._timeouts.extend(other._timeouts)
-        heapq.heapify(self._timeouts)
+        self._timeouts.merge(other._timeouts)
 
         # Make other reference the merged data structures.  This is
         # necessary because other's tasks may reference and use other
         # (e.g. to add a new task in response to an event).
         other._queue       = self._queue
-        other._read_waits  = self._read_waits
-        other._write_waits = self._write_waits
-        other._exc_waits   = self._exc_waits
+        other._poller      = self._poller
         other._queue_waits = self._queue_waits
         other._timeouts    = self._timeouts
 
@@ -911,7 +1368,7 @@ class TaskManager(object):
         otherwise
 
         """
-        return bool(self._read_waits or self._write_waits or self._exc_waits)
+        return bool(self._poller)
 
     def has_timeouts(self):
         """
@@ -939,7 +1396,7 @@ class TaskManager(object):
 
         If there are runnable tasks in the queue when run_next() is
         called, then it will check for I/O readiness using a
-        non-blocking call to select() (i.e. a poll), and only
+        non-blocking call to the poller, and only
         already-expired timeouts will be handled.  This ensures both
         that the task manager is never idle when tasks can be run and
         that tasks waiting for I/O never starve.
@@ -952,6 +1409,10 @@ class TaskManager(object):
         if self.has_timeouts():
             self._handle_timeouts(self._fix_run_timeout(timeout))
 
+        # Limit the optimistic I/O so that a task that always finds its
+        # socket ready cannot keep the run cycle from polling
+        self._optimistic = self.OPTIMISTIC_LIMIT
+
         # Run all tasks currently in the queue
         #for dummy in xrange(len(self._queue)):
         while len(self._queue) > 0:
@@ -986,68 +1447,51 @@ class TaskManager(object):
             timeout = 0.0
         elif self.has_timeouts():
             # If there are timeouts, block only until the first expiration
-            expiration_timeout = max(0.0, self._timeouts[0][0] - time.time())
+            expiration_timeout = max(0.0, self._timeouts.next_expiration() - time.time())
             if (timeout is None) or (timeout > expiration_timeout):
                 timeout = expiration_timeout
         return timeout
 
     def _handle_io_waits(self, timeout):
-        # The error handling here is (mostly) borrowed from Twisted
-        try:
-            read_ready, write_ready, exc_ready = \
-                select.select(self._read_waits,
-                              self._write_waits,
-                              self._exc_waits,
-                              timeout)
-        except (TypeError, ValueError):
-            self._remove_bad_file_descriptors()
+        ready, bad = self._poller.poll(timeout)
+        for fd in bad:
+            if fd._expires():
+                self._remove_timeout(fd)
+        if ready is None:
             return False
-        except (select.error, IOError), err:
-            if err[0] == errno.EINTR:
-                return False
-            elif ((err[0] == errno.EBADF) or
-                  ((sys.platform == 'win32') and
-                   (err[0] == 10038))):  # WSAENOTSOCK
-                self._remove_bad_file_descriptors()
-                return False
-            else:
-                # Not an error we can handle, so die
-                raise
-        else:
-            for fd in set(read_ready + write_ready + exc_ready):
-                try:
-                    input = (fd._eval() if isinstance(fd, FDAction) else None)
-                    self._enqueue(fd.task, input=input)
-                except:
-                    self._enqueue(fd.task, exc_info=sys.exc_info())
-                fd._remove_from_fdsets(self._read_waits,
-                                       self._write_waits,
-                                       self._exc_waits)
-                if fd._expires():
-                    self._remove_timeout(fd)
-            return True
-
-    def _remove_bad_file_descriptors(self):
-        for fd in (self._read_waits | self._write_waits | self._exc_waits):
+        for fd in ready:
             try:
-                select.select([fd], [fd], [fd], 0.0)
+                input = (fd._eval() if isinstance(fd, FDAction) else None)
+                self._enqueue(fd.task, input=input)
+            except EnvironmentError, err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue # spurious wake up, hence keep waiting
+                self._enqueue(fd.task, exc_info=sys.exc_info())
             except:
-                # TODO: do not enqueue the exception (socket.error) so that it does not crash
-                # when closing an already closed socket. See rtmplite issue #28
-                # self._enqueue(fd.task, exc_info=sys.exc_info())
-                fd._remove_from_fdsets(self._read_waits,
-                                       self._write_waits,
-                                       self._exc_waits)
-                if fd._expires():
-                    self._remove_timeout(fd)
+                self._enqueue(fd.task, exc_info=sys.exc_info())
+            self._poller.unregister(fd)
+            if fd._expires():
+                self._remove_timeout(fd)
+        return True
+
+    def forget(self, fd):
+        """
+
+        Stop waiting on the file descriptor fd (an integer or an
+        object with a fileno() method), which must be done before
+        closing a descriptor that may still be open in another process
+        or through a duplicate.  Tasks waiting on it are not resumed.
+
+        """
+
+        self._poller.forget(fd if _is_file_descriptor(fd) else fd.fileno())
 
     def _add_timeout(self, item, handler):
         item.handle_expiration = handler
-        heapq.heappush(self._timeouts, (item.expiration, item))
+        self._timeouts.add(item)
 
     def _remove_timeout(self, item):
-        self._timeouts.remove((item.expiration, item))
-        heapq.heapify(self._timeouts)
+        self._timeouts.remove(item)
 
     def _handle_timeouts(self, timeout):
         if (not self.has_runnable()) and (timeout > 0.0):
@@ -1055,8 +1499,7 @@ class TaskManager(object):
 
         current_time = time.time()
 
-        while self._timeouts and (self._timeouts[0][0] <= current_time):
-            item = heapq.heappop(self._timeouts)[1]
+        for item in self._timeouts.expired(current_time):
             if isinstance(item, _SleepDelay):
                 self._enqueue(item.task)
             else:
@@ -1082,15 +1525,22 @@ class TaskManager(object):
             self._enqueue(task, input=output)
 
     def _handle_fdready(self, task, output):
-        output._add_to_fdsets(self._read_waits,
-                              self._write_waits,
-                              self._exc_waits)
+        if isinstance(output, FDAction) and output.optimistic and self._optimistic > 0:
+            self._optimistic -= 1
+            try:
+                self._enqueue(task, input=output._eval())
+                return
+            except EnvironmentError, err:
+                if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._enqueue(task, exc_info=sys.exc_info())
+                    return
+            except:
+                self._enqueue(task, exc_info=sys.exc_info())
+                return
+        self._poller.register(output)
         if output._expires():
             self._add_timeout(output,
-                              (lambda:
-                               output._remove_from_fdsets(self._read_waits,
-                                                          self._write_waits,
-                                                          self._exc_waits)))
+                              (lambda: self._poller.unregister(output)))
 
     def _handle_queue_action(self, task, output):
         get_waits, put_waits = self._queue_waits[output.queue]
@@ -1201,6 +1651,11 @@ def run():
     get_default_task_manager().run()
 
 
+def forget(fd):
+    'Stop waiting on fd in the default TaskManager instance, before closing it'
+    get_default_task_manager().forget(fd)
+
+
 
 ################################################################################
 #
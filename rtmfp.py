@@ -428,6 +428,7 @@ Describe the man-in-middle mode that enables audio/video flowing through the ser
 '''
 
 import sys
+import errno
 import itertools
 import urlparse
 import re
@@ -2436,6 +2437,7 @@ class FlashServer(object):
         if not self.sockUdp:
             sock = self.sockUdp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setblocking(0) # for optimistic recvfrom in serverudplistener
             sock.bind((options.host, options.port))
             logging.debug('FlashServer.start() listening udp on %s:%s' % sock.getsockname())
             multitask.add(self.serverudplistener())
@@ -2456,7 +2458,7 @@ class FlashServer(object):
         try:
             while True:
                 self.manage()
-                data, remote = yield multitask.recvfrom(self.sockUdp, max_size)
+                data, remote = yield multitask.recvfrom(self.sockUdp, max_size, optimistic=True)
                 logging.debug('<= %s:%d [%d]' % (remote[0], remote[1], len(data)))
                 if len(data) < 12:
                     logging.debug('FlashServer.serverudplistener() invalid packet of length %d' % len(data))
@@ -2487,7 +2489,12 @@ class FlashServer(object):
 
     def send(self, data, remote): # a wrapper around socket.sendto for local UDP socket
         logging.debug('=> %s:%d [%d]' % (remote[0], remote[1], len(data)))
-        return self.sockUdp.sendto(data, remote)
+        try:
+            return self.sockUdp.sendto(data, remote)
+        except socket.error as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            return 0 # send buffer of non-blocking socket is full, drop the datagram as the network would
 
     def group(self, id):
         for group in self._groups:
@@ -22,6 +22,14 @@ To start the server with a different directory for recording and playing FLV fil
 $ python rtmp.py -r some-other-directory/
 Note the terminal '/' in the directory name. Without this, it is just used as a prefix in FLV file names.
 
+To use more than one CPU core, start the server with some worker processes. Each connection is passed to the worker
+that owns its app path, so that the publishers and players of the same scope are always in the same process.
+$ python rtmp.py -w 4
+
+A scope with more players than one process can serve, e.g., the "live" app, can instead be spread across the workers. Each
+stream published in it is then written to a ring buffer in shared memory, from which the players in other workers read.
+$ python rtmp.py -w 4 --shared live
+
 A test client is available in testClient directory, and can be compiled using Flex Builder. Alternatively, you can use the SWF file to launch
 from testClient/bin-debug after starting the server. Once you have launched the client in the browser, you can connect to
 local host by clicking on 'connect' button. Then click on publish button to publish a stream. Open another browser with
@@ -61,7 +69,7 @@ throw an exception and display the error message.
 
 '''
 
-import os, sys, time, struct, socket, traceback, multitask, amf, hashlib, hmac, random
+import os, sys, time, struct, socket, errno, traceback, bisect, mmap, collections, itertools, threading, atexit, zlib, tempfile, shutil, signal, multitask, amf, hashlib, hmac, random
 
 _debug = False
 
@@ -72,39 +80,77 @@ def truncate(data, max=100):
     return data and len(data)>max and data[:max] + '...(%d)'%(len(data),) or data
 
 class SockStream(object):
-    '''A class that represents a socket as a stream'''
+    '''A class that represents a socket as a stream. The received bytes are kept in a bytearray between the start and end
+    index, which is filled using recv_into, so that a read consumes from the front without copying the rest of the buffer.'''
+    MIN_RECV_SIZE, MAX_RECV_SIZE = 4096, 262144 # bounds of the adaptive receive size
+
     def __init__(self, sock):
-        self.sock, self.buffer = sock, ''
+        sock.setblocking(0) # so that a large send returns after partial write instead of blocking every other task
+        self.sock, self.buffer, self.start, self.end = sock, bytearray(4*SockStream.MIN_RECV_SIZE), 0, 0
+        self.recvSize = SockStream.MIN_RECV_SIZE
         self.bytesWritten = self.bytesRead = 0
 
     def close(self):
         self.sock.close()
 
+    @property
+    def pending(self):
+        '''Number of bytes received but not yet read.'''
+        return self.end - self.start
+
     def read(self, count):
+        while self.end - self.start < count: # don't have enough data in buffer
+            yield self.fill()
+        start = self.start; self.start += count
+        raise StopIteration(memoryview(self.buffer)[start:self.start].tobytes())
+
+    def fill(self):
+        '''Receive more data from the socket after the end of the buffer. Raises ConnectionClosed if the socket is closed.'''
         try:
-            while True:
-                if len(self.buffer) >= count: # do have enough data in buffer
-                    data, self.buffer = self.buffer[:count], self.buffer[count:]
-                    raise StopIteration(data)
-                if _debug: print 'socket.read[%d] calling recv()'%(count,)
-                data = (yield multitask.recv(self.sock, 4096)) # read more from socket
-                if not data: raise ConnectionClosed
-                if _debug: print 'socket.read[%d] %r'%(len(data), truncate(data))
-                self.bytesRead += len(data)
-                self.buffer += data
-        except StopIteration: raise
+            self._reserve(self.recvSize)
+            if _debug: print 'socket.fill[%d] calling recv_into(%d)'%(self.end - self.start, self.recvSize)
+            size = (yield multitask.recv_into(self.sock, memoryview(self.buffer)[self.end:], self.recvSize, optimistic=True)) # read more from socket
+            if not size: raise ConnectionClosed
+            if _debug: print 'socket.fill[%d] %r'%(size, truncate(str(self.buffer[self.end:self.end+size])))
+            self.bytesRead += size
+            self.end += size
+            # grow the receive size when socket has more backlog than we asked, and shrink when it is mostly idle.
+            if size >= self.recvSize: self.recvSize = min(self.recvSize * 2, SockStream.MAX_RECV_SIZE)
+            elif size < self.recvSize / 4: self.recvSize = max(self.recvSize / 2, SockStream.MIN_RECV_SIZE)
         except: raise ConnectionClosed # anything else is treated as connection closed.
 
+    def _reserve(self, size):
+        '''Make room for size more bytes after end, by moving the pending bytes to the front if at least half the buffer
+        is already consumed, or by allocating a larger buffer otherwise.'''
+        if len(self.buffer) - self.end >= size: return
+        pending = self.end - self.start
+        if pending <= self.start and len(self.buffer) - pending >= size:
+            self.buffer[:pending] = self.buffer[self.start:self.end] # same length slice, so the bytearray is not resized
+        else:
+            buffer = bytearray(max(2 * len(self.buffer), pending + size))
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+        self.start, self.end = 0, pending
+
     def unread(self, data):
-        self.buffer = data + self.buffer
+        if len(data) <= self.start:
+            self.start -= len(data)
+            self.buffer[self.start:self.start+len(data)] = data
+        else:
+            self.buffer, self.start, self.end = bytearray(data) + self.buffer[self.start:self.end], 0, len(data) + self.end - self.start
 
     def write(self, data):
-        while len(data) > 0: # write in 4K chunks each time
-            chunk, data = data[:4096], data[4096:]
-            self.bytesWritten += len(chunk)
-            if _debug: print 'socket.write[%d] %r'%(len(chunk), truncate(chunk))
-            try: yield multitask.send(self.sock, chunk)
+        '''Write all of data, which may be str or bytearray, using as few sends as the socket allows.'''
+        view, offset = memoryview(data), 0
+        while offset < len(view):
+            if _debug: print 'socket.write[%d] %r'%(len(view) - offset, truncate(view[offset:offset+100].tobytes()))
+            try: sent = (yield multitask.send(self.sock, view[offset:], optimistic=(offset == 0))) # after a partial send wait for the socket to be writable
+            except socket.error, e:
+                if e[0] not in (errno.EAGAIN, errno.EWOULDBLOCK): raise ConnectionClosed
+                sent = 0 # socket was writable but send buffer got full before us, try again.
             except: raise ConnectionClosed
+            self.bytesWritten += sent
+            offset += sent
 
 
 '''
@@ -185,36 +231,48 @@ class Header(object):
     # Chunk type 2 = TIME
     # Chunk type 3 = SEPARATOR
     FULL, MESSAGE, TIME, SEPARATOR, MASK = 0x00, 0x40, 0x80, 0xC0, 0xC0
+    __slots__ = ('channel', 'time', 'size', 'type', 'streamId', 'delta', 'extendedTime', 'currentTime', 'hdrtype')
 
-    def __init__(self, channel=0, time=0, size=None, type=None, streamId=0):
+    # precompiled formats of the chunk message header after the basic header, for chunk type 0, 1 and 2. The 3 bytes fields of
+    # time and size are packed as separate bytes so that the little-endian streamId fits in the same format.
+    _full, _message, _time, _extended = struct.Struct('<BBBBBBBI'), struct.Struct('<BBBBBBB'), struct.Struct('<BBB'), struct.Struct('>I')
+    _basic = [chr(x) for x in xrange(256)] # basic header indexed by (control | channel) for channel < 64, i.e., the byte itself
+    _basicLarge = {} # cache of basic header bytes indexed by (channel, control) for channel >= 64
 
+    def __init__(self, channel=0, time=0, size=None, type=None, streamId=0):
         self.channel = channel   # in fact, this will be the fmt + cs id
         self.time = time         # timestamp[delta]
         self.size = size         # message length
         self.type = type         # message type id
         self.streamId = streamId # message stream id
 
-        if (channel < 64): self.hdrdata = struct.pack('>B', channel)
-        elif (channel < 320): self.hdrdata = '\x00' + struct.pack('>B', channel-64)
-        else: self.hdrdata = '\x01' + struct.pack('>H', channel-64)
+    @staticmethod
+    def basicHeader(channel, control):
+        '''Return the basic header bytes for the channel (chunk stream id) and control (chunk type).'''
+        if channel < 64: return Header._basic[control | channel]
+        data = Header._basicLarge.get((channel, control), None)
+        if data is None:
+            if (channel < 320): data = chr(control) + struct.pack('>B', channel-64)
+            else: data = chr(control | 0x01) + struct.pack('>H', channel-64)
+            Header._basicLarge[(channel, control)] = data
+        return data
 
     def toBytes(self, control):
-        data = chr(ord(self.hdrdata[0]) | control)
-        if len(self.hdrdata) >= 2: data += self.hdrdata[1:]
-
-        # if the chunk type is not 3
-        if control != Header.SEPARATOR:
-            data += struct.pack('>I', self.time if self.time < 0xFFFFFF else 0xFFFFFF)[1:] # add time in 3 bytes
-            # if the chunk type is not 2
-            if control != Header.TIME:
-                data += struct.pack('>I', self.size)[1:] # add size in 3 bytes
-                data += struct.pack('>B', self.type) # add type in 1 byte
-                # if the chunk type is not 1
-                if control != Header.MESSAGE:
-                    data += struct.pack('<I', self.streamId) # add streamId in little-endian 4 bytes
-            # add the extended time part to the header if timestamp[delta] >= 16777215
-            if self.time >= 0xFFFFFF:
-                data += struct.pack('>I', self.time)
+        data = Header._basic[control | self.channel] if self.channel < 64 else Header.basicHeader(self.channel, control)
+        if control == Header.SEPARATOR: # chunk type 3 has only the basic header
+            return data
+        time = self.time if self.time < 0xFFFFFF else 0xFFFFFF
+        if control == Header.FULL: # add time and size in 3 bytes, type in 1 byte and streamId in little-endian 4 bytes
+            size = self.size
+            data += Header._full.pack(time >> 16, (time >> 8) & 0xff, time & 0xff, size >> 16, (size >> 8) & 0xff, size & 0xff, self.type, self.streamId)
+        elif control == Header.MESSAGE: # add time and size in 3 bytes and type in 1 byte
+            size = self.size
+            data += Header._message.pack(time >> 16, (time >> 8) & 0xff, time & 0xff, size >> 16, (size >> 8) & 0xff, size & 0xff, self.type)
+        else: # add time in 3 bytes
+            data += Header._time.pack(time >> 16, (time >> 8) & 0xff, time & 0xff)
+        # add the extended time part to the header if timestamp[delta] >= 16777215
+        if time == 0xFFFFFF:
+            data += Header._extended.pack(self.time)
         return data
 
     def __repr__(self):
@@ -231,8 +289,10 @@ class Message(object):
     0x01,         0x02,    0x03,  0x04,         0x05,         0x06,        0x08,  0x09,  0x0F,  0x10,       0x11, 0x12, 0x13,      0x14, 0x16
     type_name = dict(enumerate('unknown chunk-size abort ack user-control win-ack-size set-peer-bw unknown audio video unknown unknown unknown unknown unknown data3 sharedobj3 rpc3 data sharedobj rpc unknown aggregate'.split()))
 
+    __slots__ = ('header', 'data', 'chunks')
+
     def __init__(self, hdr=None, data=''):
-        self.header, self.data = hdr or Header(), data
+        self.header, self.data, self.chunks = hdr or Header(), data, None
 
     # define properties type, streamId and time to access self.header.(property)
     for p in ['type', 'streamId', 'time']:
@@ -246,31 +306,124 @@ class Message(object):
         return ("<Message header=%r data=%r>"% (self.header, truncate(self.data)))
 
     def dup(self):
-        return Message(self.header.dup(), self.data[:])
+        result = Message(self.header.dup(), self.data[:])
+        result.chunks = self.chunks # duplicates share the chunked data cache, if any
+        return result
+
+    def chunked(self, chunkSize, channel):
+        '''Return the data split in chunkSize pieces joined by type-3 chunk headers of the channel, i.e., everything after
+        the first chunk header on the wire. If chunks is a dict shared among duplicates of this message, such as the copies
+        of a published message sent to all the players, the result is computed once for each (chunkSize, channel).'''
+        cached = self.chunks.get((chunkSize, channel), None) if self.chunks is not None else None
+        if cached is None or cached[0] is not self.data: # not yet computed, or the data was changed, e.g., in onPlayData
+            data = self.data
+            cached = (data, Header(channel).toBytes(Header.SEPARATOR).join([data[i:i+chunkSize] for i in xrange(0, len(data), chunkSize)]))
+            if self.chunks is not None: self.chunks[(chunkSize, channel)] = cached
+        return cached[1]
+
+class WriteQueue(multitask.Queue):
+    '''The write queue of a Protocol, which gives the queued messages in the order of priority: messages of the protocol
+    channel, i.e., types below AUDIO sent on PROTOCOL_CHANNEL_ID, then RPC, data and shared object messages, then audio and
+    then video. Within a level the streams take turns for one message each, and the messages of a stream are in order. The
+    None item that closes the writer is given after all the queued messages.'''
+    PROTOCOL, COMMAND, AUDIO, VIDEO = range(4) # priority levels, highest first
+
+    def __init__(self):
+        multitask.Queue.__init__(self)
+        self.levels = [(dict(), collections.deque()) for i in xrange(4)] # per level, queue of each stream id and turns of stream ids
+        self.count, self.closed = 0, False
+
+    @staticmethod
+    def level(message):
+        return WriteQueue.PROTOCOL if message.type < Message.AUDIO else WriteQueue.AUDIO if message.type == Message.AUDIO else WriteQueue.VIDEO if message.type == Message.VIDEO else WriteQueue.COMMAND
+
+    def __len__(self):
+        return self.count + (1 if self.closed else 0)
+
+    def _put(self, item):
+        if item is None: self.closed = True; return
+        streams, turns = self.levels[WriteQueue.level(item)]
+        queue = streams.get(item.streamId, None)
+        if queue is None: queue = streams[item.streamId] = collections.deque(); turns.append(item.streamId)
+        queue.append(item); self.count += 1
+
+    def _get(self):
+        for streams, turns in self.levels:
+            if turns:
+                streamId = turns.popleft()
+                queue = streams[streamId]; item = queue.popleft()
+                if queue: turns.append(streamId) # next turn after the other streams of this level
+                else: del streams[streamId]
+                self.count -= 1
+                return item
+        self.closed = False
+        return None
+
+    def unget(self, item):
+        '''Put back an item just taken by get, so that it is the next item of its stream.'''
+        streams, turns = self.levels[WriteQueue.level(item)]
+        queue = streams.get(item.streamId, None)
+        if queue is None: queue = streams[item.streamId] = collections.deque(); turns.appendleft(item.streamId)
+        queue.appendleft(item); self.count += 1
 
 class Protocol(object):
-    PING_SIZE, DEFAULT_CHUNK_SIZE, HIGH_WRITE_CHUNK_SIZE, PROTOCOL_CHANNEL_ID = 1536, 128, 4096, 2 # constants
-    READ_WIN_SIZE, WRITE_WIN_SIZE = 1000000L, 1073741824L
+    PING_SIZE, DEFAULT_CHUNK_SIZE, HIGH_WRITE_CHUNK_SIZE, PROTOCOL_CHANNEL_ID = 1536, 128, 65536, 2 # constants
+    READ_WIN_SIZE, WRITE_WIN_SIZE = 1000000L, 2500000L
+    MAX_UNACKED_WINDOWS, WINDOW_TIMEOUT = 2, 5 # pause media when unacked bytes exceed these many windows, for at most these seconds
+    MAX_QUEUE_BYTES, MAX_QUEUE_DELAY = 4194304, 3.0 # a player is slow if its live media waits beyond these many bytes or seconds
+    QUEUE_POLICY = 'drop' # what to do with live video for a slow player, 'drop' frames or 'queue' all
+    MAX_WRITE_BATCH = 262144 # stop collecting queued messages for one socket write beyond these many bytes
+    MAX_INCOMPLETE_BYTES = 8388608 # close the connection if partially received messages hold more than these many bytes
 
     def __init__(self, sock):
         self.stream = SockStream(sock)
         self.lastReadHeaders, self.incompletePackets, self.lastWriteHeaders = dict(), dict(), dict()
+        self.incompleteBytes = 0 # total bytes held in incompletePackets
         self.readChunkSize = self.writeChunkSize = Protocol.DEFAULT_CHUNK_SIZE
         self.readWinSize0, self.readWinSize, self.writeWinSize0, self.writeWinSize = 0L, self.READ_WIN_SIZE, 0L, self.WRITE_WIN_SIZE
+        self.bufferTimes = dict() # buffer time in millisec set by the client, indexed by stream id
         self.nextChannelId = Protocol.PROTOCOL_CHANNEL_ID + 1
         self._time0 = time.time()
-        self.writeQueue = multitask.Queue()
+        self.writeQueue = WriteQueue()
+        self.acked, self.windowQueue, self.windowPauses = False, None, 0 # whether peer sends ACK, queue to signal the paused writer
+        self.liveQueue, self.liveEntries, self.liveBytes, self.skipping = collections.deque(), dict(), 0, set() # [message, time, size] of live media in writeQueue, also by id(message), and stream ids dropping video until keyframe
+        self.droppedFrames = self.droppedGops = self.droppedBytes = 0
 
     @property
     def relativeTime(self):
         return int(1000*(time.time() - self._time0))
 
+    @property
+    def unackedBytes(self):
+        '''Number of bytes written to the socket but not yet acknowledged by the peer, or 0 if the peer never sent an ACK.
+        The ACK sequence number is 32-bit, hence it wraps around after 4GB.'''
+        if not self.acked: return 0
+        unacked = (self.stream.bytesWritten - self.writeWinSize0) & 0xFFFFFFFF
+        return unacked if unacked < 0x80000000 else 0 # peer counted more than we wrote, e.g., excluding the handshake
+
+    @property
+    def windowFull(self):
+        '''Whether the send window is exhausted. The peer acknowledges after every window size bytes received, hence up to
+        one window is unacked even for a fast peer, and media writes are paused only beyond MAX_UNACKED_WINDOWS windows.'''
+        return self.unackedBytes >= Protocol.MAX_UNACKED_WINDOWS * self.writeWinSize
+
+    def waitWindow(self):
+        '''Wait until an ACK from the peer opens the send window, or a message not subject to the window is queued. Returns
+        True after WINDOW_TIMEOUT seconds in case the peer stopped sending ACKs, so that the writer continues anyway.'''
+        self.windowQueue, self.windowPauses, timedout = multitask.Queue(), self.windowPauses + 1, False
+        if _debug: print 'Protocol.waitWindow unacked=%d window=%d'%(self.unackedBytes, self.writeWinSize)
+        try: yield self.windowQueue.get(timeout=Protocol.WINDOW_TIMEOUT)
+        except multitask.Timeout: timedout = True
+        self.windowQueue = None
+        raise StopIteration(timedout)
+
     def messageReceived(self, msg): # override in subclass
         yield
 
     def protocolMessage(self, msg):
-        if msg.type == Message.ACK: # respond to ACK requests
-            self.writeWinSize0 = struct.unpack('>L', msg.data)[0]
+        if msg.type == Message.ACK: # update the acknowledged bytes, and resume the writer if it was waiting for the window
+            self.writeWinSize0, self.acked = struct.unpack('>L', msg.data)[0], True
+            if self.windowQueue is not None and not self.windowFull: yield self.windowQueue.put(True)
 #            response = Message()
 #            response.type, response.data = msg.type, msg.data
 #            yield self.writeMessage(response)
@@ -283,6 +436,7 @@ class Protocol(object):
             type, data = struct.unpack('>H', msg.data[:2])[0], msg.data[2:]
             if type == 3: # client expects a response when it sends set buffer length
                 streamId, bufferTime = struct.unpack('>II', data)
+                self.bufferTimes[streamId] = bufferTime
                 response = Message()
                 response.time, response.type, response.data = self.relativeTime, Message.USER_CONTROL, struct.pack('>HI', 0, streamId)
                 yield self.writeMessage(response)
@@ -291,10 +445,11 @@ class Protocol(object):
     def connectionClosed(self):
         yield
 
-    def parse(self):
+    def parse(self, handshake=True):
         try:
-            yield self.parseCrossDomainPolicyRequest() # check for cross domain policy
-            yield self.parseHandshake()  # parse rtmp handshake
+            if handshake: # not if already done by the Acceptor of a multi-process server
+                yield self.parseCrossDomainPolicyRequest() # check for cross domain policy
+                yield self.parseHandshake()  # parse rtmp handshake
             yield self.parseMessages()   # parse messages
         except ConnectionClosed:
             yield self.connectionClosed()
@@ -306,6 +461,42 @@ class Protocol(object):
 
     def writeMessage(self, message):
         yield self.writeQueue.put(message)
+        if self.windowQueue is not None and (message is None or WriteQueue.level(message) < WriteQueue.AUDIO): yield self.windowQueue.put(True) # not subject to the window
+
+    @property
+    def liveDelay(self):
+        '''Seconds since the oldest live media message still in the write queue was queued.'''
+        return time.time() - self.liveQueue[0][1] if self.liveQueue else 0
+
+    def writeLive(self, message):
+        '''Queue a live media message for this player, dropping video if the player is slower than the stream. When the queued
+        live media exceeds half of MAX_QUEUE_BYTES or MAX_QUEUE_DELAY, disposable inter frames are dropped. Beyond the limit,
+        the rest of the GOP is dropped up to the next keyframe, and then whole GOPs until the queue drains below the limit.
+        Audio, sequence headers and other messages are always queued.'''
+        if message.type == Message.VIDEO and Protocol.QUEUE_POLICY == 'drop' and not FLV.isSequenceHeader(message.type, message.data):
+            frameType = ord(message.data[0]) >> 4 if message.data else 0
+            load = max(float(self.liveBytes) / Protocol.MAX_QUEUE_BYTES, self.liveDelay / Protocol.MAX_QUEUE_DELAY)
+            if message.streamId in self.skipping or load >= 1:
+                if frameType == 1 and load < 1: self.skipping.discard(message.streamId) # resume at keyframe
+                else:
+                    if frameType == 1 or message.streamId not in self.skipping: self.droppedGops += 1
+                    self.skipping.add(message.streamId)
+                    self.droppedFrames, self.droppedBytes = self.droppedFrames + 1, self.droppedBytes + message.size
+                    raise StopIteration
+            elif frameType == 3 and load >= 0.5: # disposable inter frame
+                self.droppedFrames, self.droppedBytes = self.droppedFrames + 1, self.droppedBytes + message.size
+                raise StopIteration
+        entry = self.liveEntries[id(message)] = [message, time.time(), message.size]
+        self.liveQueue.append(entry); self.liveBytes += message.size
+        yield self.writeQueue.put(message)
+
+    def _dequeued(self, message):
+        '''Update the live media accounting for a message taken from the write queue. Audio is taken before the video queued
+        earlier, hence the entry is cleared in place and removed when it reaches the front.'''
+        entry = self.liveEntries.pop(id(message), None)
+        if entry is not None:
+            self.liveBytes -= entry[2]; entry[0] = None
+            while self.liveQueue and self.liveQueue[0][0] is None: self.liveQueue.popleft()
 
     def parseCrossDomainPolicyRequest(self):
         # read the request
@@ -380,92 +571,18 @@ class Protocol(object):
         return (''.join([chr(random.randint(0, 255)) for i in xrange(128)]), '')
 
     def parseMessages(self):
-        '''Parses complete messages until connection closed. Raises ConnectionLost exception.'''
-        CHANNEL_MASK = 0x3F
+        '''Parses complete messages until connection closed. Raises ConnectionLost exception. All the complete chunks already
+        received are decoded at once by parseChunks, and the socket is read again only when more data is needed.'''
+        stream = self.stream
         while True:
-            hdrsize = ord((yield self.stream.read(1))[0])  # read header size byte
-            channel = hdrsize & CHANNEL_MASK
-            if channel == 0: # we need one more byte
-                channel = 64 + ord((yield self.stream.read(1))[0])
-            elif channel == 1: # we need two more bytes
-                data = (yield self.stream.read(2))
-                channel = 64 + ord(data[0]) + 256 * ord(data[1])
-
-            hdrtype = hdrsize & Header.MASK   # read header type byte
-            if hdrtype == Header.FULL or not self.lastReadHeaders.has_key(channel):
-                header = Header(channel)
-                self.lastReadHeaders[channel] = header
-            else:
-                header = self.lastReadHeaders[channel]
-
-            if hdrtype < Header.SEPARATOR: # time or delta has changed
-                data = (yield self.stream.read(3))
-                header.time = struct.unpack('!I', '\x00' + data)[0]
-
-            if hdrtype < Header.TIME: # size and type also changed
-                data = (yield self.stream.read(3))
-                header.size = struct.unpack('!I', '\x00' + data)[0]
-                header.type = ord((yield self.stream.read(1))[0])
-
-            if hdrtype < Header.MESSAGE: # streamId also changed
-                data = (yield self.stream.read(4))
-                header.streamId = struct.unpack('<I', data)[0]
-
-            if header.time == 0xFFFFFF: # if we have extended timestamp, read it
-                data = (yield self.stream.read(4))
-                header.extendedTime = struct.unpack('!I', data)[0]
-                if _debug: print 'extended time stamp', '%x'%(header.extendedTime,)
-            else:
-                header.extendedTime = None
-
-            if hdrtype == Header.FULL:
-                header.currentTime = header.extendedTime or header.time
-                header.hdrtype = hdrtype
-            elif hdrtype in (Header.MESSAGE, Header.TIME):
-                header.hdrtype = hdrtype
-
-            #print header.type, '0x%02x'%(hdrtype,), header.time, header.currentTime
-
-            # if _debug: print 'R', header, header.currentTime, header.extendedTime, '0x%x'%(hdrsize,)
+            messages, stream.start = self.parseChunks(stream.buffer, stream.start, stream.end)
 
-            data = self.incompletePackets.get(channel, "") # are we continuing an incomplete packet?
-
-            count = min(header.size - (len(data)), self.readChunkSize) # how much more
-
-            data += (yield self.stream.read(count))
-
-            # check if we need to send Ack
-            if self.readWinSize is not None:
-                if self.stream.bytesRead > (self.readWinSize0 + self.readWinSize):
-                    self.readWinSize0 = self.stream.bytesRead
-                    ack = Message()
-                    ack.time, ack.type, ack.data = self.relativeTime, Message.ACK, struct.pack('>L', self.readWinSize0)
-                    yield self.writeMessage(ack)
-
-            if len(data) < header.size: # we don't have all data
-                self.incompletePackets[channel] = data
-            else: # we have all data
-                if hdrtype in (Header.MESSAGE, Header.TIME):
-                    header.currentTime = header.currentTime + (header.extendedTime or header.time)
-                elif hdrtype == Header.SEPARATOR:
-                    if header.hdrtype in (Header.MESSAGE, Header.TIME):
-                        header.currentTime = header.currentTime + (header.extendedTime or header.time)
-                if len(data) == header.size:
-                    if channel in self.incompletePackets:
-                        del self.incompletePackets[channel]
-                        if _debug:
-                            print 'aggregated %r bytes message: readChunkSize(%r) x %r'%(len(data), self.readChunkSize, len(data) / self.readChunkSize)
-                else:
-                    data, self.incompletePackets[channel] = data[:header.size], data[header.size:]
-
-                hdr = Header(channel=header.channel, time=header.currentTime, size=header.size, type=header.type, streamId=header.streamId)
-                msg = Message(hdr, data)
-
-                if hdr.type == Message.AGGREGATE:
+            for msg in messages:
+                if msg.type == Message.AGGREGATE:
                     ''' see http://code.google.com/p/red5/source/browse/java/server/trunk/src/org/red5/server/net/rtmp/event/Aggregate.java / getParts()
                     '''
                     if _debug: print 'Protocol.parseMessages aggregated msg=', msg
-                    aggdata = data;
+                    aggdata = msg.data;
                     while len(aggdata) > 0:
                         '''
                         type=1 byte
@@ -479,7 +596,7 @@ class Protocol(object):
                         subsize = struct.unpack('!I', '\x00' + aggdata[1:4])[0]
                         subtime = struct.unpack('!I', aggdata[4:8])[0]
                         substreamid = struct.unpack('<I', aggdata[8:12])[0]
-                        subheader = Header(channel, time=subtime, size=subsize, type=subtype, streamId=substreamid) # TODO: set correct channel
+                        subheader = Header(msg.header.channel, time=subtime, size=subsize, type=subtype, streamId=substreamid) # TODO: set correct channel
                         aggdata = aggdata[11:] # skip header
                         submsgdata = aggdata[:subsize] # get message data
                         submsg = Message(subheader, submsgdata)
@@ -495,6 +612,114 @@ class Protocol(object):
                 else:
                     yield self.parseMessage(msg)
 
+            # check if we need to send Ack
+            if self.readWinSize is not None:
+                if stream.bytesRead > (self.readWinSize0 + self.readWinSize):
+                    self.readWinSize0 = stream.bytesRead
+                    ack = Message()
+                    ack.time, ack.type, ack.data = self.relativeTime, Message.ACK, struct.pack('>L', self.readWinSize0)
+                    yield self.writeMessage(ack)
+
+            yield stream.fill() # the rest of the buffer, if any, is an incomplete chunk
+
+    _uint24, _uint24_8, _uint32le, _uint32 = struct.Struct('>BH'), struct.Struct('>BHB'), struct.Struct('<I'), struct.Struct('>I')
+
+    def parseChunks(self, buffer, start, end):
+        '''Decode all the complete chunks in buffer[start:end], which is a bytearray, without doing any I/O. It returns a tuple
+        (messages, offset), where messages is a list of the complete Message objects and offset is the index of the first
+        chunk that is not yet completely received. The per channel header state is updated only for the complete chunks.
+        A set chunk size message on the protocol channel is applied immediately, since it affects the following chunks.'''
+        CHANNEL_MASK = 0x3F
+        messages, lastReadHeaders, incompletePackets, view = [], self.lastReadHeaders, self.incompletePackets, memoryview(buffer)
+        while start < end:
+            hdrsize, offset = buffer[start], start + 1 # header size byte
+            channel = hdrsize & CHANNEL_MASK
+            if channel == 0: # we need one more byte
+                if offset + 1 > end: break
+                channel, offset = 64 + buffer[offset], offset + 1
+            elif channel == 1: # we need two more bytes
+                if offset + 2 > end: break
+                channel, offset = 64 + buffer[offset] + 256 * buffer[offset+1], offset + 2
+
+            hdrtype = hdrsize & Header.MASK   # read header type byte
+            header = lastReadHeaders.get(channel, None) if hdrtype != Header.FULL else None
+
+            if hdrtype < Header.SEPARATOR: # time or delta has changed
+                if offset + 3 > end: break
+                hi, lo = Protocol._uint24.unpack_from(buffer, offset)
+                time, offset = (hi << 16) | lo, offset + 3
+            else:
+                time = header.time if header is not None else 0
+
+            if hdrtype < Header.TIME: # size and type also changed
+                if offset + 4 > end: break
+                hi, lo, type = Protocol._uint24_8.unpack_from(buffer, offset)
+                size, offset = (hi << 16) | lo, offset + 4
+            else:
+                size, type = (header.size, header.type) if header is not None else (None, None)
+
+            if hdrtype < Header.MESSAGE: # streamId also changed
+                if offset + 4 > end: break
+                streamId, = Protocol._uint32le.unpack_from(buffer, offset)
+                offset += 4
+
+            if time == 0xFFFFFF: # if we have extended timestamp, read it
+                if offset + 4 > end: break
+                extendedTime, = Protocol._uint32.unpack_from(buffer, offset)
+                offset += 4
+                if _debug: print 'extended time stamp', '%x'%(extendedTime,)
+            else:
+                extendedTime = None
+
+            packet = incompletePackets.get(channel, None) # are we continuing an incomplete packet?
+            count = min(size - (packet[0] if packet is not None else 0), self.readChunkSize) # how much more
+            if offset + count > end: break
+
+            # now that the complete chunk is available, update the header state
+            if header is None:
+                header = Header(channel)
+                lastReadHeaders[channel] = header
+            if hdrtype < Header.SEPARATOR: header.time = time
+            if hdrtype < Header.TIME: header.size, header.type = size, type
+            if hdrtype < Header.MESSAGE: header.streamId = streamId
+            header.extendedTime = extendedTime
+
+            if hdrtype == Header.FULL:
+                header.currentTime = header.extendedTime or header.time
+                header.hdrtype = hdrtype
+            elif hdrtype in (Header.MESSAGE, Header.TIME):
+                header.hdrtype = hdrtype
+
+            # if _debug: print 'R', header, header.currentTime, header.extendedTime, '0x%x'%(hdrsize,)
+
+            data = view[offset:offset+count].tobytes()
+            start = offset + count
+
+            if (packet[0] if packet is not None else 0) + count < header.size: # we don't have all data
+                if packet is None: packet = incompletePackets[channel] = [0, []] # bytes received and list of chunks
+                packet[0] += count; packet[1].append(data)
+                self.incompleteBytes += count
+                if self.incompleteBytes > Protocol.MAX_INCOMPLETE_BYTES:
+                    raise ValueError('incomplete messages exceed %d bytes'%(Protocol.MAX_INCOMPLETE_BYTES,))
+            else: # we have all data
+                if hdrtype in (Header.MESSAGE, Header.TIME):
+                    header.currentTime = header.currentTime + (header.extendedTime or header.time)
+                elif hdrtype == Header.SEPARATOR:
+                    if header.hdrtype in (Header.MESSAGE, Header.TIME):
+                        header.currentTime = header.currentTime + (header.extendedTime or header.time)
+                if packet is not None: # join the chunks only once when the message is complete
+                    del incompletePackets[channel]
+                    self.incompleteBytes -= packet[0]
+                    packet[1].append(data); data = ''.join(packet[1])
+                    if _debug:
+                        print 'aggregated %r bytes message: readChunkSize(%r) x %r'%(len(data), self.readChunkSize, len(data) / self.readChunkSize)
+
+                hdr = Header(channel=header.channel, time=header.currentTime, size=header.size, type=header.type, streamId=header.streamId)
+                msg = Message(hdr, data)
+                messages.append(msg)
+                if channel == Protocol.PROTOCOL_CHANNEL_ID and hdr.type == Message.CHUNK_SIZE: # applies to the next chunk
+                    self.readChunkSize = struct.unpack('>L', data)[0]
+        return (messages, start)
 
     def parseMessage(self, msg):
         try:
@@ -507,54 +732,83 @@ class Protocol(object):
             if _debug: print 'Protocol.parseMessage exception', (traceback and traceback.print_exc() or None)
 
     def write(self):
-        '''Writes messages to stream'''
+        '''Writes messages to stream in the order of priority of the WriteQueue. All the messages already queued are chunked in
+        to one buffer which is sent with a single socket write, so that a burst of audio and video messages does not cost one
+        send per message. While the send window is full, an audio or video message is put back in the queue after sending the
+        messages before it, and the writer waits for an ACK or a message of higher priority.'''
+        force = False # the wait for the window timed out, hence send the next batch anyway
         while True:
-#            while self.writeQueue.empty(): (yield multitask.sleep(0.01))
-#            message = self.writeQueue.get() # TODO this should be used using multitask.Queue and remove previous wait.
-            message = yield self.writeQueue.get() # TODO this should be used using multitask.Queue and remove previous wait.
-            if _debug: print 'Protocol.write msg=', message
+            message, output = (yield self.writeQueue.get()), bytearray()
+            while message is not None:
+                if _debug: print 'Protocol.write msg=', message
+                if (message.type == Message.AUDIO or message.type == Message.VIDEO) and not force and self.acked and self.unackedBytes + len(output) >= Protocol.MAX_UNACKED_WINDOWS * self.writeWinSize:
+                    self.writeQueue.unget(message)
+                    if not output: force = (yield self.waitWindow())
+                    break
+                self._dequeued(message)
+                self.writeChunks(message, output)
+                if self.writeQueue.empty() or len(output) >= Protocol.MAX_WRITE_BATCH: break
+                message = (yield self.writeQueue.get())
+            if output:
+                force = False
+                try:
+                    yield self.stream.write(output)
+                except ConnectionClosed:
+                    yield self.connectionClosed()
+                except:
+                    print traceback.print_exc()
             if message is None:
                 try: self.stream.close()  # just in case TCP socket is not closed, close it.
                 except: pass
                 break
 
-            # get the header stored for the stream
-            if self.lastWriteHeaders.has_key(message.streamId):
-                header = self.lastWriteHeaders[message.streamId]
-            else:
-                if self.nextChannelId <= Protocol.PROTOCOL_CHANNEL_ID: self.nextChannelId = Protocol.PROTOCOL_CHANNEL_ID+1
-                header, self.nextChannelId = Header(self.nextChannelId), self.nextChannelId + 1
-                self.lastWriteHeaders[message.streamId] = header
-            if message.type < Message.AUDIO:
-                header = Header(Protocol.PROTOCOL_CHANNEL_ID)
-
-            # now figure out the header data bytes
-            if header.streamId != message.streamId or header.time == 0 or message.time <= header.time:
-                header.streamId, header.type, header.size, header.time, header.delta = message.streamId, message.type, message.size, message.time, message.time
-                control = Header.FULL
-            elif header.size != message.size or header.type != message.type:
-                header.type, header.size, header.time, header.delta = message.type, message.size, message.time, message.time-header.time
-                control = Header.MESSAGE
-            else:
-                header.time, header.delta = message.time, message.time-header.time
-                control = Header.TIME
-
-            hdr = Header(channel=header.channel, time=header.delta if control in (Header.MESSAGE, Header.TIME) else header.time, size=header.size, type=header.type, streamId=header.streamId)
-            assert message.size == len(message.data)
-
-            data = ''
-            while len(message.data) > 0:
-                data += hdr.toBytes(control) # gather header bytes
-                count = min(self.writeChunkSize, len(message.data))
-                data += message.data[:count]
-                message.data = message.data[count:]
-                control = Header.SEPARATOR # incomplete message continuation
-            try:
-                yield self.stream.write(data)
-            except ConnectionClosed:
-                yield self.connectionClosed()
-            except:
-                print traceback.print_exc()
+    def writeChunks(self, message, output):
+        '''Append the chunks of the message, with the appropriate chunk headers, to the output bytearray. Each message type
+        of a stream has its own chunk stream, so that interleaved audio and video do not reset each other's header state,
+        and a message with the same type, size and timestamp delta as the previous one on its chunk stream needs only a
+        type-3 header.'''
+        # get the header stored for the stream and type
+        key = (message.streamId, message.type)
+        if key in self.lastWriteHeaders:
+            header = self.lastWriteHeaders[key]
+        else:
+            if self.nextChannelId <= Protocol.PROTOCOL_CHANNEL_ID: self.nextChannelId = Protocol.PROTOCOL_CHANNEL_ID+1
+            header, self.nextChannelId = Header(self.nextChannelId), self.nextChannelId + 1
+            self.lastWriteHeaders[key] = header
+        if message.type < Message.AUDIO:
+            header = Header(Protocol.PROTOCOL_CHANNEL_ID)
+
+        # now figure out the header data bytes
+        if header.type is None or header.streamId != message.streamId or message.time < header.time:
+            header.streamId, header.type, header.size, header.time, header.delta = message.streamId, message.type, message.size, message.time, message.time
+            control = Header.FULL
+        elif header.size != message.size or header.type != message.type:
+            header.type, header.size, header.time, header.delta = message.type, message.size, message.time, message.time-header.time
+            control = Header.MESSAGE
+        elif header.hdrtype != Header.FULL and message.time - header.time == header.delta and header.delta < 0xFFFFFF:
+            header.time = message.time
+            control = Header.SEPARATOR # the receiver adds the previous delta
+        else:
+            header.time, header.delta = message.time, message.time-header.time
+            control = Header.TIME
+        header.hdrtype = control
+
+        hdr = Header(channel=header.channel, time=header.delta if control in (Header.MESSAGE, Header.TIME) else header.time, size=header.size, type=header.type, streamId=header.streamId)
+        assert message.size == len(message.data)
+
+        if message.chunks is not None: # chunked data is shared with other players, only the first header is ours
+            if message.data: output += hdr.toBytes(control); output += message.chunked(self.writeChunkSize, header.channel)
+            return
+        data, offset = message.data, 0
+        while offset < len(data):
+            count = min(self.writeChunkSize, len(data) - offset)
+            output += hdr.toBytes(control) # gather header bytes
+            output += buffer(data, offset, count) # and payload without an intermediate copy
+            offset += count
+            control = Header.SEPARATOR # incomplete message continuation
+        if message.type == Message.CHUNK_SIZE: # applies to the next chunk
+            self.writeChunkSize = struct.unpack('>L', data)[0]
+            if _debug: print "set write chunk size to %d" % self.writeChunkSize
 
 class Command(object):
     ''' Class for command / data messages'''
@@ -638,61 +892,278 @@ def getfilename(path, name, root):
     if _debug: print 'filename=', result
     return result
 
+class CachedFLV(object):
+    '''A memory mapped FLV file shared by all the FLV readers of the file through FLVCache. The tag headers are parsed
+    once, and kept in tags indexed by file offset as (type, time, body, next offset) where body is a zero-copy buffer of
+    the mapped file. The keyframe index is loaded from the sidecar file, or built on first use by index(). As the file is
+    played, the limits of the FLVCache it is in are checked every CHECK_TAGS newly parsed tags, and after every remap.'''
+    TAG_SIZE = 200 # approximate bytes of memory used by a parsed tag in tags
+    CHECK_TAGS = 1024 # newly parsed tags between checks of the cache limits
+
+    def __init__(self, path):
+        fp = open(path, 'rb')
+        try:
+            st = os.fstat(fp.fileno())
+            magic, version, flags, offset = struct.unpack('!3sBBI', fp.read(9))
+            if _debug: print 'FLV.open() hdr=', magic, version, flags, offset
+            if magic != 'FLV': raise ValueError('This is not a FLV file')
+            if version != 1: raise ValueError('Unsupported FLV file version')
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally: fp.close()
+        self.path, self.mtime, self.size = path, st.st_mtime, st.st_size # size and mtime when opened, to validate the cache
+        self.dataOffset = offset + 4 # of the first tag, after the first previous tag size
+        self.tags, self.cache = {}, None # cache is the FLVCache this is in, if any
+        self.keyTimes, self.keyOffsets = FLV.loadIndex(path)
+
+    @property
+    def bytes(self):
+        '''Approximate memory used by this file, i.e., the mapped size and the parsed tags.'''
+        return len(self.map) + len(self.tags) * CachedFLV.TAG_SIZE
+
+    def remap(self, size):
+        '''Re-map the file if it has grown to at least size bytes, e.g., while it is being recorded, and return True if
+        the new mapping has size bytes. The old mapping remains valid for the already parsed tags that refer to it.'''
+        try: fp = open(self.path, 'rb')
+        except IOError: return False
+        try:
+            if os.fstat(fp.fileno()).st_size < size: return False
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally: fp.close()
+        if self.cache is not None: self.cache.evict()
+        return True
+
+    def tag(self, offset):
+        '''Return the tag at the file offset as (type, time, body, next offset), or None if there is no complete tag.'''
+        tag = self.tags.get(offset)
+        if tag is None:
+            if offset + 15 > len(self.map) and not self.remap(offset + 15): return None
+            type, len0, len1, ts0, ts1, ts2, sid0, sid1 = struct.unpack_from('>BBHBHBBH', self.map, offset)
+            length = (len0 << 16) | len1; ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
+            if offset + 15 + length > len(self.map) and not self.remap(offset + 15 + length): return None # incomplete last tag
+            ptagsize, = struct.unpack_from('>I', self.map, offset + 11 + length)
+            if ptagsize != (length+11):
+                if _debug: print 'invalid previous tag-size found:', ptagsize, '!=', (length+11),'ignored.'
+            tag = self.tags[offset] = (type, ts, buffer(self.map, offset + 11, length), offset + 15 + length)
+            if self.cache is not None and len(self.tags) % CachedFLV.CHECK_TAGS == 0: self.cache.evict()
+        return tag
+
+    def index(self):
+        '''Return the keyframe index as (keyTimes, keyOffsets). If not known, it is built by walking all the tag headers
+        once, without keeping them in tags, and saved in the sidecar file.'''
+        if self.keyTimes is None:
+            keyTimes, keyOffsets, offset, data = [], [], self.dataOffset, self.map
+            while offset + 13 <= len(data): # tag header and first two bytes of data
+                type, len0, len1, ts0, ts1, ts2, sid0, sid1 = struct.unpack_from('>BBHBHBBH', data, offset)
+                length = (len0 << 16) | len1; ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
+                if type == Message.VIDEO and FLV.isKeyframe(data[offset+11:offset+11+min(length, 2)]) and (not keyTimes or ts >= keyTimes[-1]):
+                    keyTimes.append(ts); keyOffsets.append(offset)
+                offset += 11 + length + 4
+            self.keyTimes, self.keyOffsets = keyTimes, keyOffsets
+            if _debug: print 'FLV.buildIndex() keyframes=', len(keyTimes)
+            FLV.saveIndex(self.path, keyTimes, keyOffsets)
+        return (self.keyTimes, self.keyOffsets)
+
+class FLVCache(object):
+    '''A process-wide cache of CachedFLV indexed by path, so that all the players of a file share one memory mapping and
+    its parsed tags, instead of opening and parsing the file for every player. An entry is valid as long as the size and
+    modification time of the file do not change. The least recently used entries are evicted when the total bytes exceed
+    maxBytes, or when there are more than maxFiles entries. An evicted entry remains in use by its current readers.'''
+    def __init__(self, maxBytes=1073741824, maxFiles=256):
+        self.maxBytes, self.maxFiles = maxBytes, maxFiles
+        self.files = collections.OrderedDict() # CachedFLV indexed by path, from least to most recently used
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, path):
+        '''Return the CachedFLV for the path, opening the file if it is not cached or has changed.'''
+        entry = self.files.pop(path, None)
+        if entry is not None:
+            st = os.stat(path)
+            if (st.st_mtime, st.st_size) != (entry.mtime, entry.size): entry.cache = None; entry = None
+        if entry is None:
+            self.misses += 1
+            entry = CachedFLV(path); entry.cache = self
+        else:
+            self.hits += 1
+        self.files[path] = entry # most recently used is last
+        self.evict()
+        return entry
+
+    def evict(self):
+        '''Remove the least recently used entries, except the most recent, while the cache exceeds its limits.'''
+        total = sum([x.bytes for x in self.files.itervalues()])
+        while len(self.files) > 1 and (total > self.maxBytes or len(self.files) > self.maxFiles):
+            path, entry = self.files.popitem(last=False)
+            total -= entry.bytes; self.evictions += 1; entry.cache = None
+            if _debug: print 'FLVCache.evict()', path
+
+    def clear(self):
+        '''Remove all the entries, e.g., after the files are modified in place.'''
+        for entry in self.files.itervalues(): entry.cache = None
+        self.files.clear()
+
+    def stats(self):
+        '''Return a dict with the number of cached files, parsed tags, approximate bytes of memory used, and the counters.'''
+        return dict(files=len(self.files), tags=sum([len(x.tags) for x in self.files.itervalues()]), bytes=sum([x.bytes for x in self.files.itervalues()]),
+                    maxBytes=self.maxBytes, maxFiles=self.maxFiles, hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+class FLVWriter(object):
+    '''A bounded in-memory buffer of data to write to a file opened by FLV for recording, drained by a background thread,
+    so that a slow disk does not stall the event loop. The thread writes and flushes the buffered data every FLUSH_INTERVAL
+    seconds, or as soon as FLUSH_SIZE bytes, or half of MAX_PENDING, are buffered. When MAX_PENDING bytes are not yet
+    written, write() either drops the data or blocks the caller until the thread catches up, depending on POLICY. The
+    thread closes the file after close(). The counters are available using stats().'''
+    FLUSH_INTERVAL, FLUSH_SIZE, MAX_PENDING = 0.5, 262144, 16777216
+    POLICY = 'drop' # or 'block' when MAX_PENDING is reached
+    active = set() # writers that are not yet closed, so that they are closed on exit
+
+    def __init__(self, fp):
+        self.fp, self.items, self.closed, self.callback, self.error = fp, [], False, None, None
+        self.queued = self.pending = 0 # bytes not yet taken by the thread, and not yet written
+        self.written = self.writes = self.dropped = self.droppedBytes = 0
+        self.latency = self.maxLatency = 0.0 # seconds to write and flush the last and the slowest batch
+        self.cond = threading.Condition()
+        FLVWriter.active.add(self)
+        self.thread = threading.Thread(target=self.run, name='FLVWriter ' + str(getattr(fp, 'name', '')))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data, position=None, force=False):
+        '''Buffer the data to write at the position in the file, or at the end if None. Return False if the data is dropped
+        because MAX_PENDING bytes are pending and POLICY is drop. Data with position or force is never dropped.'''
+        with self.cond:
+            if self.pending + len(data) > FLVWriter.MAX_PENDING and position is None and not force:
+                if FLVWriter.POLICY != 'block':
+                    self.dropped += 1; self.droppedBytes += len(data)
+                    return False
+                while self.pending + len(data) > FLVWriter.MAX_PENDING and self.pending > 0: self.cond.wait()
+            self.items.append((position, data)); self.queued += len(data); self.pending += len(data)
+            if self.queued >= min(FLVWriter.FLUSH_SIZE, FLVWriter.MAX_PENDING / 2): self.cond.notifyAll()
+        return True
+
+    def close(self, callback=None):
+        '''Write the remaining data and close the file in the thread without waiting, and then invoke the callback.'''
+        with self.cond:
+            self.closed, self.callback = True, callback
+            self.cond.notifyAll()
+
+    def run(self):
+        while True:
+            with self.cond:
+                end = time.time() + FLVWriter.FLUSH_INTERVAL
+                while not self.closed and self.queued < min(FLVWriter.FLUSH_SIZE, FLVWriter.MAX_PENDING / 2) and time.time() < end: self.cond.wait(end - time.time())
+                items, closed, self.items, self.queued = self.items, self.closed, [], 0
+            if items: self.flush(items)
+            if closed: break
+        try: self.fp.close()
+        except: pass
+        FLVWriter.active.discard(self)
+        if self.callback is not None: self.callback()
+
+    def flush(self, items):
+        '''Write the items of (position, data) to the file, joining the consecutive ones at the end in one write.'''
+        start, size = time.time(), sum([len(x[1]) for x in items])
+        try:
+            if self.error is None:
+                data = []
+                for position, item in items:
+                    if position is None: data.append(item)
+                    else:
+                        if data: self.fp.write(''.join(data)); data = []
+                        end = self.fp.tell()
+                        self.fp.seek(position, os.SEEK_SET); self.fp.write(item); self.fp.seek(end, os.SEEK_SET)
+                if data: self.fp.write(''.join(data))
+                self.fp.flush()
+        except (IOError, OSError), e: # the rest of the data is discarded, e.g., if disk is full
+            if _debug: print 'FLVWriter.flush() failed', e
+            self.error = e
+        latency = time.time() - start
+        with self.cond:
+            self.pending -= size; self.writes += 1; self.latency, self.maxLatency = latency, max(self.maxLatency, latency)
+            if self.error is None: self.written += size
+            self.cond.notifyAll()
+
+    def stats(self):
+        '''Return a dict with the bytes pending and written, the number of writes, dropped data and the write latency.'''
+        with self.cond:
+            return dict(pending=self.pending, written=self.written, writes=self.writes, dropped=self.dropped, droppedBytes=self.droppedBytes,
+                        latency=self.latency, maxLatency=self.maxLatency, error=self.error and str(self.error))
+
+    @staticmethod
+    def closeAll(timeout=5.0):
+        '''Close all the active writers and wait for them to write the remaining data, e.g., on exit.'''
+        writers = list(FLVWriter.active)
+        for writer in writers: writer.close(writer.callback)
+        for writer in writers: writer.thread.join(timeout)
+
+atexit.register(FLVWriter.closeAll)
+
 class FLV(object):
-    '''An FLV file which converts between RTMP message and FLV tags.'''
+    '''An FLV file which converts between RTMP message and FLV tags. The keyframe index of the file, i.e., the timestamps
+    and file offsets of the video keyframes, is kept in keyTimes and keyOffsets. It is built by write() while recording and
+    saved in a sidecar file named by appending .idx to the file name, or built on first seek() for a file without one.
+    For recording all the writes go through an FLVWriter in writer, and the duration in the metadata at the start of the
+    file is updated every DURATION_INTERVAL millisec of media. If the writer drops a video tag, the following video tags
+    are skipped until the next keyframe. For playback the memory mapped file is shared with other readers using the
+    process-wide FLVCache in cache, and reader() sends all the tags due in PACING_WINDOW millisec in one wake up. After
+    open or seek, reader() first sends the client's buffer time worth of media as fast as possible, and then paces in
+    real time keeping that lead.'''
+    PACING_WINDOW = 40 # millisec of media sent by reader() in one wake up
+    PAUSE_CHECK_INTERVAL = 10 # seconds between checks by a paused reader() whether the stream is closed
+    FAST_START = None # millisec of media sent ahead of real time by reader(), or None to use the client's buffer time
+    MAX_FAST_START = 10000 # limit on the lead in millisec, for clients with very large buffer time
+    DURATION_INTERVAL = 10000 # millisec of media recorded between the updates of duration in the file
+    cache = FLVCache()
+
     def __init__(self):
-        self.fname = self.fp = self.type = None
+        self.fname = self.fp = self.type = self.file = self.started = self.writer = None
         self.tsp = self.tsr = 0; self.tsr0 = None
+        self.paused, self.resumed = False, multitask.Queue() # the reader waits on resumed while paused
+        self.keyTimes = self.keyOffsets = None # keyframe index, or None if not known
 
     def open(self, path, type='read', mode=0775):
         '''Open the file for reading (type=read) or writing (type=record or append).'''
         if str(path).find('/../') >= 0 or str(path).find('\\..\\') >= 0: raise ValueError('Must not contain .. in name')
         if _debug: print 'opening file', path
-        self.tsp = self.tsr = 0; self.tsr0 = None; self.tsr1 = 0; self.type = type
+        self.tsp = self.tsr = 0; self.tsr0 = None; self.tsr1 = 0; self.type = type; self.fname = path; self.started = None
         if type in ('record', 'append'):
             try: os.makedirs(os.path.dirname(path), mode)
             except: pass
             if type == 'record' or not os.path.exists(path): # if file does not exist, use record mode
                 self.fp = open(path, 'w+b')
-                self.fp.write('FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00') # the header and first previousTagSize
-                self.writeDuration(0.0)
+                data = 'FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00' + self.durationTag(0.0) # the header, first previous tag size and metadata
+                self.writer = FLVWriter(self.fp); self.writer.write(data, force=True)
+                self.offset = len(data)
+                self.keyTimes, self.keyOffsets = [], []
             else:
+                self.keyTimes, self.keyOffsets = FLV.loadIndex(path) # remains None if the existing file has no valid index, and then it is not extended
                 self.fp = open(path, 'r+b')
-                self.fp.seek(-4, os.SEEK_END)
-                ptagsize, = struct.unpack('>I', self.fp.read(4))
-                self.fp.seek(-4-ptagsize, os.SEEK_END)
-                bytes = self.fp.read(ptagsize)
-                type, len0, len1, ts0, ts1, ts2, sid0, sid1 = struct.unpack('>BBHBHBBH', bytes[:11])
-                ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
-                self.tsr1 = ts + 20; # some offset after the last packet
+                self.tsr1 = FLV.lastTime(self.fp) + 20; # some offset after the last packet
                 self.fp.seek(0, os.SEEK_END)
+                self.offset = self.fp.tell()
+                self.writer = FLVWriter(self.fp)
+            self.durationTime, self.skipVideo = 0, False # media time of last duration update, and whether to skip until keyframe
         else:
-            self.fp = open(path, 'rb')
-            magic, version, flags, offset = struct.unpack('!3sBBI', self.fp.read(9))
-            if _debug: print 'FLV.open() hdr=', magic, version, flags, offset
-            if magic != 'FLV': raise ValueError('This is not a FLV file')
-            if version != 1: raise ValueError('Unsupported FLV file version')
-            if offset > 9: self.fp.seek(offset-9, os.SEEK_CUR)
-            self.fp.read(4) # ignore first previous tag size
+            self.file = FLV.cache.get(path)
+            self.position = self.file.dataOffset # of the next tag to read
         return self
 
     def close(self):
         '''Close the underlying file for this object.'''
         if _debug: print 'closing flv file'
-        if self.type in ('record', 'append') and self.tsr0 is not None:
-            self.writeDuration((self.tsr - self.tsr0)/1000.0)
-        if self.fp is not None:
-            try: self.fp.close()
-            except: pass
-            self.fp = None
+        if self.writer is not None: # the writer closes the file in its thread, and then the index is saved
+            if self.tsr0 is not None: self.writeDuration((self.tsr - self.tsr0)/1000.0)
+            fname, keyTimes, keyOffsets = self.fname, self.keyTimes, self.keyOffsets
+            self.writer.close(keyTimes is not None and (lambda: FLV.saveIndex(fname, keyTimes, keyOffsets)) or None)
+            self.writer = self.fp = None
+        self.file = None # the shared file is not closed, since other readers and queued messages may refer to it.
 
     def delete(self, path):
         '''Delete the underlying file for this object.'''
         try: os.unlink(path)
         except: pass
 
-    def writeDuration(self, duration):
-        if _debug: print 'writing duration', duration
+    def durationTag(self, duration):
+        '''Return the data tag with onMetaData of the given duration, which always has the same size.'''
         output = amf.BytesIO()
         amfWriter = amf.AMF0(output) # TODO: use AMF3 if needed
         amfWriter.write('onMetaData')
@@ -700,11 +1171,12 @@ class FLV(object):
         output.seek(0); data = output.read()
         length, ts = len(data), 0
         data = struct.pack('>BBHBHB', Message.DATA, (length >> 16) & 0xff, length & 0x0ffff, (ts >> 16) & 0xff, ts & 0x0ffff, (ts >> 24) & 0xff) + '\x00\x00\x00' +  data
-        data += struct.pack('>I', len(data))
-        lastpos = self.fp.tell()
-        if lastpos != 13: self.fp.seek(13, os.SEEK_SET)
-        self.fp.write(data)
-        if lastpos != 13: self.fp.seek(lastpos, os.SEEK_SET)
+        return data + struct.pack('>I', len(data))
+
+    def writeDuration(self, duration):
+        '''Overwrite the metadata tag after the file header with the given duration.'''
+        if _debug: print 'writing duration', duration
+        self.writer.write(self.durationTag(duration), 13)
 
     def write(self, message):
         '''Write a message to the file, assuming it was opened for writing or appending.'''
@@ -719,7 +1191,89 @@ class FLV(object):
             # if message.type == Message.AUDIO: print 'w', message.type, ts
             data = struct.pack('>BBHBHB', message.type, (length >> 16) & 0xff, length & 0x0ffff, (ts >> 16) & 0xff, ts & 0x0ffff, (ts >> 24) & 0xff) + '\x00\x00\x00' +  message.data
             data += struct.pack('>I', len(data))
-            self.fp.write(data)
+            keyframe = message.type == Message.VIDEO and FLV.isKeyframe(message.data)
+            config = FLV.isSequenceHeader(message.type, message.data)
+            if message.type == Message.VIDEO and self.skipVideo and not keyframe and not config:
+                self.writer.dropped += 1; self.writer.droppedBytes += len(data)
+                return
+            if not self.writer.write(data, force=config):
+                if message.type == Message.VIDEO: self.skipVideo = True
+                return
+            if keyframe:
+                self.skipVideo = False
+                if self.keyTimes is not None and (not self.keyTimes or ts >= self.keyTimes[-1]): self.keyTimes.append(ts); self.keyOffsets.append(self.offset)
+            self.offset += len(data)
+            if ts - self.durationTime >= FLV.DURATION_INTERVAL:
+                self.durationTime = ts; self.writeDuration(ts/1000.0)
+
+    @staticmethod
+    def isKeyframe(data):
+        '''Whether the video tag data is a keyframe, excluding the AVC sequence header.'''
+        return len(data) > 0 and ord(data[0]) >> 4 == 1 and data[:2] != '\x17\x00'
+
+    @staticmethod
+    def isSequenceHeader(type, data):
+        '''Whether the audio or video tag data is an AAC or AVC sequence header, which is needed to decode the rest.'''
+        if type == Message.VIDEO: return data[:2] == '\x17\x00'
+        return type == Message.AUDIO and len(data) > 1 and ord(data[0]) >> 4 == 10 and data[1] == '\x00'
+
+    @staticmethod
+    def lastTime(fp):
+        '''Return the timestamp of the last tag in the file object, using the previous tag size at the end.'''
+        fp.seek(-4, os.SEEK_END)
+        ptagsize, = struct.unpack('>I', fp.read(4))
+        fp.seek(-4-ptagsize, os.SEEK_END)
+        bytes = fp.read(ptagsize)
+        type, len0, len1, ts0, ts1, ts2, sid0, sid1 = struct.unpack('>BBHBHBBH', bytes[:11])
+        return (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
+
+    @staticmethod
+    def loadIndex(path):
+        '''Return the keyframe index (keyTimes, keyOffsets) from the sidecar file of the path, if it was saved for the current
+        size of the file and is not older, or (None, None).'''
+        try:
+            f = open(path + '.idx', 'rb'); data = f.read(); f.close()
+            magic, size, count = struct.unpack('>4sQI', data[:16])
+            if magic != 'FLVI' or size != os.path.getsize(path) or len(data) != 16 + 12 * count \
+              or os.path.getmtime(path + '.idx') < os.path.getmtime(path): return (None, None)
+            if _debug: print 'FLV.loadIndex() keyframes=', count
+            return (list(struct.unpack('>%dI'%(count,), data[16:16+4*count])), list(struct.unpack('>%dQ'%(count,), data[16+4*count:])))
+        except: return (None, None) # missing or invalid sidecar file
+
+    @staticmethod
+    def saveIndex(path, keyTimes, keyOffsets):
+        '''Save the keyframe index in the sidecar file of the path, ignoring any error such as a read-only directory.'''
+        try:
+            count = len(keyTimes)
+            data = struct.pack('>4sQI', 'FLVI', os.path.getsize(path), count) + struct.pack('>%dI'%(count,), *keyTimes) + struct.pack('>%dQ'%(count,), *keyOffsets)
+            f = open(path + '.idx', 'wb'); f.write(data); f.close()
+        except:
+            if _debug: print 'FLV.saveIndex() failed', (sys and sys.exc_info() or None)
+
+    def readTags(self, until):
+        '''Return a tuple (tags, eof) where tags is a list of (type, time, body) of the tags from the current position of
+        the file reader before the timestamp until, but at least one, and eof indicates that the end of the file is reached.
+        The body is a zero-copy buffer of the shared memory mapped file, which is re-mapped if the file has grown.'''
+        result, position, file = [], self.position, self.file
+        while True:
+            tag = file.tag(position)
+            if tag is None or result and tag[1] >= until: break
+            result.append(tag[:3]); position = tag[3]
+        self.position = position
+        return (result, not result)
+
+    def metaData(self, body):
+        '''Parse the AMF0 body of a data tag and return a tuple (name, value), e.g., ('onMetaData', {...}).'''
+        amfReader = amf.AMF0(str(body)) # TODO: use AMF3 if needed
+        return (amfReader.read(), amfReader.read())
+
+    def delay(self, client, streamId):
+        '''Return the seconds to wait until the media at tsp is due, for the reader that started at wall clock and media
+        time in started. The media is sent ahead of real time by FAST_START millisec if set, or else the buffer time set
+        by the client for the stream, limited to MAX_FAST_START.'''
+        lead = FLV.FAST_START if FLV.FAST_START is not None else getattr(client, 'bufferTimes', {}).get(streamId, 0)
+        start, base = self.started
+        return (self.tsp - base - min(lead, FLV.MAX_FAST_START)) / 1000.0 - (time.time() - start)
 
     def reader(self, stream):
         '''A generator to periodically read the file and dispatch them to the stream. The supplied stream
@@ -727,61 +1281,180 @@ class FLV(object):
         if _debug: print 'reader started'
         yield
         try:
-            while self.fp is not None:
-                bytes = self.fp.read(11)
-                if len(bytes) == 0:
+            while self.file is not None:
+                if self.paused: # suspended until resumed, but check once in a while if the stream is closed
+                    try: yield self.resumed.get(timeout=FLV.PAUSE_CHECK_INTERVAL)
+                    except multitask.Timeout: pass
+                    if stream is None or stream.client is None: break
+                    continue
+                if self.started is None: self.started = (time.time(), self.tsp) # after open or seek
+                until = self.tsp + FLV.PACING_WINDOW
+                tags, eof = self.readTags(until)
+                if stream is None or stream.client is None: break # if it is closed
+                if eof:
                     try: tm = stream.client.relativeTime
                     except: tm = 0
                     response = Command(name='onStatus', id=stream.id, tm=tm, args=[amf.Object(level='status',code='NetStream.Play.Stop', description='File ended', details=None)])
                     yield stream.send(response.toMessage())
                     break
-                type, len0, len1, ts0, ts1, ts2, sid0, sid1 = struct.unpack('>BBHBHBBH', bytes)
-                length = (len0 << 16) | len1; ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
-                body = self.fp.read(length); ptagsize, = struct.unpack('>I', self.fp.read(4))
-                if ptagsize != (length+11):
-                    if _debug: print 'invalid previous tag-size found:', ptagsize, '!=', (length+11),'ignored.'
-                if stream is None or stream.client is None: break # if it is closed
-                #hdr = Header(3 if type == Message.AUDIO else 4, ts if ts < 0xffffff else 0xffffff, length, type, stream.id)
-                hdr = Header(0, ts, length, type, stream.id)
-                msg = Message(hdr, body)
-                # if _debug: print 'FLV.read() length=', length, 'hdr=', hdr
-                # if hdr.type == Message.AUDIO: print 'r', hdr.type, hdr.time
-                if type == Message.DATA: # metadata
-                    amfReader = amf.AMF0(body) # TODO: use AMF3 if needed
-                    name = amfReader.read()
-                    obj = amfReader.read()
-                    if _debug: print 'FLV.read()', name, repr(obj)
-                yield stream.send(msg)
-                if ts > self.tsp:
-                    diff, self.tsp = ts - self.tsp, ts
+                for type, ts, body in tags:
+                    if type == Message.DATA and _debug: print 'FLV.read()', self.metaData(body)
+                    yield stream.send(Message(Header(0, ts, len(body), type, stream.id), body))
+                self.tsp = max([until, self.tsp] + [x[1] for x in tags]) # next read is after the window, or after a later tag already sent
+                diff = self.delay(stream.client, stream.id)
+                if diff > 0:
                     if _debug: print 'FLV.read() sleep', diff
-                    yield multitask.sleep(diff / 1000.0)
+                    yield multitask.sleep(diff)
         except StopIteration: pass
         except:
             if _debug: print 'closing the reader', (sys and sys.exc_info() or None)
-            if self.fp is not None:
-                try: self.fp.close()
-                except: pass
-                self.fp = None
+            self.close()
+
+    def pause(self, paused):
+        '''For file reader, suspend the reader task, or resume it, after which the buffer time of media is sent as fast as
+        possible as after seek.'''
+        self.paused = paused
+        if not paused:
+            self.started = None
+            yield self.resumed.put(True)
 
     def seek(self, offset):
-        '''For file reader, try seek to the given time. The offset is in millisec'''
+        '''For file reader, seek to the nearest keyframe at or before the given time, using binary search in the keyframe
+        index. A file without video keyframes is scanned for the first tag at the time. The offset is in millisec'''
         if self.type == 'read':
             if _debug: print 'FLV.seek() offset=', offset, 'current tsp=', self.tsp
-            self.fp.seek(0, os.SEEK_SET)
-            magic, version, flags, length = struct.unpack('!3sBBI', self.fp.read(9))
-            if length > 9: self.fp.seek(length-9, os.SEEK_CUR)
-            self.fp.seek(4, os.SEEK_CUR) # ignore first previous tag size
+            self.started = None # send the buffer time of media again as fast as possible
+            keyTimes, keyOffsets = self.file.index()
+            if keyTimes:
+                index = bisect.bisect_right(keyTimes, int(offset)) - 1
+                self.tsp = keyTimes[index] if index >= 0 else 0
+                self.position = keyOffsets[index] if index >= 0 else self.file.dataOffset
+                if _debug: print 'FLV.seek() new ts=', self.tsp, 'tell', self.position
+                return
+            self.position = self.file.dataOffset
             self.tsp, ts = int(offset), 0
             while self.tsp > 0 and ts < self.tsp:
-                bytes = self.fp.read(11)
-                if not bytes: break
-                type, len0, len1, ts0, ts1, ts2, sid0, sid1 = struct.unpack('>BBHBHBBH', bytes)
-                length = (len0 << 16) | len1; ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
-                self.fp.seek(length, os.SEEK_CUR)
-                ptagsize, = struct.unpack('>I', self.fp.read(4))
-                if ptagsize != (length+11): break
-            if _debug: print 'FLV.seek() new ts=', ts, 'tell', self.fp.tell()
+                tag = self.file.tag(self.position)
+                if tag is None: break
+                ts, self.position = tag[1], tag[3]
+            if _debug: print 'FLV.seek() new ts=', ts, 'tell', self.position
+
+
+class SegmentedFLV(FLV):
+    '''A recording split into segment FLV files, which is used like an FLV. For path of name.flv the segments are in files
+    name-00001.flv, name-00002.flv, etc., and the manifest file name.segments has a line "start file" for each segment,
+    where start is the millisec of the first tag of the segment from the start of the recording. While recording, a new
+    segment is started on a keyframe, or any tag of a stream without video, after duration seconds or size bytes in the
+    segment. Each segment starts at timestamp 0 with the last sequence headers so that it can also be played by itself.
+    For playback, the tags of all the segments are read in sequence with timestamps of the whole recording, and seek()
+    opens the segment containing the time using the manifest, which is reloaded to find new segments of a live recording.'''
+    def __init__(self, duration=0, size=0):
+        FLV.__init__(self)
+        self.duration, self.size = duration, size
+        self.segment, self.segments, self.index = None, [], -1 # the current FLV, list of (start, path) and its index
+        self.skip = False # whether to skip the headers at the start of the segment
+
+    @staticmethod
+    def manifestName(path):
+        return os.path.splitext(path)[0] + '.segments'
+
+    @staticmethod
+    def loadManifest(path):
+        '''Return the list of (start, path) of the segments in the manifest file, or empty list if it cannot be read.'''
+        result, dirname = [], os.path.dirname(path)
+        try:
+            f = open(path, 'rb'); lines = f.read().splitlines(); f.close()
+            for line in lines:
+                start, ignore, name = line.partition(' ')
+                if name: result.append((int(start), os.path.join(dirname, name)))
+        except (IOError, ValueError): pass
+        return result
+
+    def open(self, path, type='read', mode=0775):
+        '''Open the recording for reading (type=read) or writing (type=record or append).'''
+        if str(path).find('/../') >= 0 or str(path).find('\\..\\') >= 0: raise ValueError('Must not contain .. in name')
+        if _debug: print 'opening segmented file', path
+        self.fname, self.type, self.tsp, self.started = path, type, 0, None
+        self.manifest = SegmentedFLV.manifestName(path)
+        self.segments = SegmentedFLV.loadManifest(self.manifest) if type != 'record' else []
+        if type in ('record', 'append'):
+            try: os.makedirs(os.path.dirname(path), mode)
+            except: pass
+            self.tsr0, self.tsr1, self.start, self.video, self.headers = None, 0, 0, False, {} # headers has the last sequence header message by type
+            if self.segments: # append after the last segment
+                start, last = self.segments[-1]
+                try:
+                    f = open(last, 'rb')
+                    try: self.tsr1 = start + FLV.lastTime(f) + 20 # some offset after the last packet
+                    finally: f.close()
+                except: self.tsr1 = start
+            self.writer = FLVWriter(open(self.manifest, 'ab' if self.segments else 'wb'))
+        else:
+            if not self.segments: raise ValueError('No segment in manifest')
+            self.openSegment(0)
+        return self
+
+    def openSegment(self, index):
+        if self.segment is not None: self.segment.close()
+        self.index, (start, path) = index, self.segments[index]
+        self.segment = FLV().open(path)
+        self.file = self.segment.file
+
+    def close(self):
+        '''Close the current segment, and the manifest file if recording.'''
+        if self.segment is not None: self.segment.close(); self.segment = None
+        if self.writer is not None: self.writer.close(); self.writer = None
+        self.file = None
+
+    def write(self, message):
+        '''Write a message to the current segment, after starting a new segment if needed.'''
+        if message.type == Message.AUDIO or message.type == Message.VIDEO:
+            if self.tsr0 is None: self.tsr0 = message.time - self.tsr1
+            ts = message.time - self.tsr0
+            if message.type == Message.VIDEO: self.video = True
+            header = FLV.isSequenceHeader(message.type, message.data)
+            if header: self.headers[message.type] = message
+            if self.segment is None or (not self.video or FLV.isKeyframe(message.data)) \
+              and (self.duration and ts - self.start >= self.duration * 1000 or self.size and self.segment.offset >= self.size):
+                self.rotate(ts, message)
+            self.segment.write(message)
+
+    def rotate(self, ts, message):
+        '''Close the current segment without waiting for it to be written, and start a new one with the sequence headers.'''
+        if self.segment is not None: self.segment.close()
+        path = '%s-%05d.flv'%(os.path.splitext(self.fname)[0], len(self.segments) + 1)
+        if _debug: print 'SegmentedFLV.rotate()', path, ts
+        self.segment, self.start = FLV().open(path, 'record'), ts
+        self.segments.append((ts, path))
+        self.writer.write('%d %s\n'%(ts, os.path.basename(path)))
+        for m in self.headers.values():
+            if m is not message: m = m.dup(); m.time = message.time; self.segment.write(m)
+
+    def readTags(self, until):
+        '''Return a tuple (tags, eof) as in FLV, continuing with the next segment at the end of a segment. The metadata and
+        sequence headers at the start of the next segment are skipped, since they were already sent.'''
+        while True:
+            start = self.segments[self.index][0]
+            tags, eof = self.segment.readTags(until - start)
+            if not eof:
+                if self.skip:
+                    while tags and (tags[0][0] == Message.DATA or FLV.isSequenceHeader(tags[0][0], tags[0][2])): del tags[0]
+                    if not tags: continue
+                    self.skip = False
+                return ([(type, ts + start, body) for type, ts, body in tags], False)
+            if self.index + 1 >= len(self.segments): self.segments = SegmentedFLV.loadManifest(self.manifest) or self.segments
+            if self.index + 1 >= len(self.segments): return ([], True)
+            self.openSegment(self.index + 1); self.skip = True
+
+    def seek(self, offset):
+        '''For reader, seek in the segment containing the given time in millisec.'''
+        if self.type == 'read':
+            self.segments = SegmentedFLV.loadManifest(self.manifest) or self.segments
+            index = max(0, bisect.bisect_right([x[0] for x in self.segments], int(offset)) - 1)
+            if index != self.index: self.openSegment(index)
+            start = self.segments[index][0]
+            self.segment.seek(int(offset) - start)
+            self.tsp, self.started, self.skip = self.segment.tsp + start, None, False
 
 
 class Stream(object):
@@ -789,7 +1462,9 @@ class Stream(object):
     count = 0;
     def __init__(self, client):
         self.client, self.id, self.name = client, 0, ''
-        self.recordfile = self.playfile = None # so that it doesn't complain about missing attribute
+        self.recordfile = self.playfile = self.gopCache = self.dvr = self.ring = None # so that it doesn't complain about missing attribute
+        self.receiveAudio = self.receiveVideo = True # as set by the player using NetStream.receiveAudio and receiveVideo
+        self.keyframesOnly = self.paused = self.waitKeyframe = False
         self.queue = multitask.Queue()
         self._name = 'Stream[' + str(Stream.count) + ']'; Stream.count += 1
         if _debug: print self, 'created'
@@ -798,7 +1473,8 @@ class Stream(object):
         if _debug: print self, 'closing'
         if self.recordfile is not None: self.recordfile.close(); self.recordfile = None
         if self.playfile is not None: self.playfile.close(); self.playfile = None
-        self.client = None # to clear the reference
+        if self.ring is not None: self.ring.close(); self.ring = None
+        self.client = self.gopCache = self.dvr = None # to clear the reference
         pass
 
     def __repr__(self):
@@ -808,22 +1484,38 @@ class Stream(object):
         '''Generator to receive new Message on this stream, or None if stream is closed.'''
         return self.queue.get()
 
-    def send(self, msg):
-        '''Method to send a Message or Command on this stream.'''
+    def accepts(self, msg):
+        '''Whether a message is sent to this stream as a player, as per receiveAudio, receiveVideo, keyframesOnly and paused.
+        Video starts again from a keyframe if waitKeyframe is set, e.g., after it is turned on again.'''
+        if msg.type == Message.AUDIO: return self.receiveAudio and not self.paused
+        if msg.type != Message.VIDEO: return True
+        if self.paused or not self.receiveVideo: return False
+        if self.keyframesOnly or self.waitKeyframe:
+            if FLV.isSequenceHeader(msg.type, msg.data): return True # needed to decode the keyframe, which is still awaited
+            if not FLV.isKeyframe(msg.data): return False
+            self.waitKeyframe = False
+        return True
+
+    def send(self, msg, live=False):
+        '''Method to send a Message or Command on this stream. A media message not accepted by this stream as a player is not
+        sent, and a live media message may be dropped if the client is slow.'''
         if isinstance(msg, Command):
             msg = msg.toMessage()
+        if not self.accepts(msg): raise StopIteration
         msg.streamId = self.id
         # if _debug: print self,'send'
-        if self.client is not None: yield self.client.writeMessage(msg)
+        if self.client is not None: yield self.client.writeLive(msg) if live else self.client.writeMessage(msg)
 
 class Client(Protocol):
-    '''The client object represents a single connected client to the server.'''
-    def __init__(self, sock, server):
+    '''The client object represents a single connected client to the server. If received is not None, the handshake is
+    already done and received has the bytes received after it, e.g., when the connection is passed by an Acceptor.'''
+    def __init__(self, sock, server, received=None):
         Protocol.__init__(self, sock)
         self.server, self.agent, self.streams, self._nextCallId, self._nextStreamId, self.objectEncoding = \
           server,      None,         {},           2,                1,                  0.0
         self.queue = multitask.Queue() # receive queue used by application
-        multitask.add(self.parse()); multitask.add(self.write())
+        if received: self.stream.unread(received)
+        multitask.add(self.parse(handshake=received is None)); multitask.add(self.write())
 
     def recv(self):
         '''Generator to receive new Message (msg, arg) on this stream, or (None,None) if stream is closed.'''
@@ -956,9 +1648,488 @@ class Server(object):
             yield self.queue.put((None, None))
             self.queue = None
 
+class WorkerServer(Server):
+    '''The server in a worker process of a multi-process FlashServer. Instead of accepting connections, it receives them
+    from the Acceptor on the given UNIX socket, each as a file descriptor followed by the bytes received after handshake.
+    An error with one connection only drops that connection, and the server terminates when the Acceptor is gone.'''
+    def run(self):
+        from multiprocessing.reduction import recv_handle
+        try:
+            while True:
+                yield multitask.readable(self.sock.fileno())
+                if not self.sock.recv(1, socket.MSG_PEEK): break # the acceptor closed the UNIX socket
+                fd = sock = None
+                try: fd = recv_handle(self.sock)
+                except: # e.g., too many open files, but the bytes of the connection still follow
+                    if _debug: print 'rtmp.WorkerServer recv_handle exception ', (sys and sys.exc_info() or None)
+                size = struct.unpack('>I', (yield self.recvall(4)))[0]
+                received = (yield self.recvall(size))
+                if fd is None: continue
+                try:
+                    sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM) # fromfd has its own descriptor
+                    if _debug: print 'connection received from acceptor', sock.getpeername()
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    client = Client(sock, self, received)
+                except:
+                    if _debug: print 'rtmp.WorkerServer connection exception ', (sys and sys.exc_info() or None)
+                    if sock is not None:
+                        try: sock.close()
+                        except: pass
+                finally: os.close(fd)
+        except GeneratorExit: pass # terminate
+        except:
+            if _debug: print 'rtmp.WorkerServer exception ', (sys and sys.exc_info() or None)
+
+        if (self.sock):
+            try: self.sock.close(); self.sock = None
+            except: pass
+        if (self.queue):
+            yield self.queue.put((None, None))
+            self.queue = None
+
+    def recvall(self, count):
+        data = ''
+        while len(data) < count:
+            more = (yield multitask.recv(self.sock, count - len(data)))
+            if not more: raise ConnectionClosed
+            data += more
+        raise StopIteration(data)
+
+class Acceptor(object):
+    '''The parent process of a multi-process FlashServer. It accepts the connections on the listening socket, does the
+    handshake and parses the messages up to the connect command, to pass the connection to the worker process owning
+    the app path of the connect command. Hence the publishers and players of a scope are always in the same process.
+    The workers is a list of (pid, UNIX socket) of the worker processes, each running a WorkerServer. The connections of
+    the app names or paths in shared are passed to the workers in turn instead. Each worker has a queue of connections
+    written to its UNIX socket by its own sender task, so that a stalled worker does not hold up the others. The workers
+    are reaped every REAP_INTERVAL seconds, and the scopes of a dead worker are routed to the next live worker, and the
+    ring files it left in ringDir are removed. When no worker is left, the listening socket is closed.'''
+    MAX_CONNECT_BYTES = 65536 # close the connection if connect is not received in these many bytes after handshake
+    REAP_INTERVAL = 1 # seconds between checks for dead workers
+
+    def __init__(self, sock, workers, shared=(), ringDir=None):
+        self.sock, self.workers, self.shared, self.turn, self.ringDir = sock, workers, shared, 0, ringDir
+        self.queues, self.dead = [multitask.Queue() for x in workers], set() # connections to pass to each worker, and indexes of dead workers
+        for index, (pid, channel) in enumerate(workers):
+            channel.setblocking(False)
+            multitask.add(self.sender(index))
+        multitask.add(self.run()); multitask.add(self.reaper())
+
+    def run(self):
+        try:
+            while self.sock:
+                try: sock, remote = (yield multitask.accept(self.sock))
+                except socket.error, e:
+                    if not self.sock or e.errno == errno.EBADF: break
+                    if _debug: print 'rtmp.Acceptor accept exception ', e
+                    yield multitask.sleep(0.1) # e.g., too many open files
+                    continue
+                if sock == None: break
+                if _debug: print 'connection received from', remote
+                multitask.add(self.route(sock))
+        except GeneratorExit: pass # terminate
+        except:
+            if _debug: print 'rtmp.Acceptor exception ', (sys and sys.exc_info() or None)
+        if (self.sock):
+            try: self.sock.close(); self.sock = None
+            except: pass
+
+    def route(self, sock):
+        '''Wait for the connect command on the connection, and pass it to the worker of its app path.'''
+        protocol, path = Protocol(sock), None
+        stream, received, offset = protocol.stream, bytearray(), 0
+        try:
+            yield protocol.parseCrossDomainPolicyRequest()
+            yield protocol.parseHandshake()
+            while path is None:
+                received += stream.buffer[stream.start:stream.end]; stream.start = stream.end # keep all the bytes for the worker
+                messages, offset = protocol.parseChunks(received, offset, len(received))
+                for msg in messages:
+                    if (msg.type == Message.RPC or msg.type == Message.RPC3) and msg.streamId == 0:
+                        cmd = Command.fromMessage(msg)
+                        if cmd.name == 'connect':
+                            agent = cmd.cmdData
+                            path = str(agent.app) if hasattr(agent, 'app') else str(agent['app']) if isinstance(agent, dict) else ''
+                            break
+                if path is None:
+                    if len(received) > Acceptor.MAX_CONNECT_BYTES: raise ValueError('connect not received')
+                    yield stream.fill()
+            yield self.dispatch(sock, path, str(received))
+        except:
+            if _debug: print 'rtmp.Acceptor.route exception ', (sys and sys.exc_info() or None)
+            Acceptor.close(sock)
+
+    @staticmethod
+    def close(sock):
+        '''Close the connection here, after removing it from the poller since it may still be open in a worker.'''
+        try: multitask.forget(sock); sock.close()
+        except: pass
+
+    def dispatch(self, sock, path, received):
+        '''Queue the socket and the bytes received after handshake for the worker of the path, or the next live worker.'''
+        count = len(self.workers)
+        if len(self.dead) == count: raise ValueError('no worker left')
+        if path in self.shared or path.partition('/')[0] in self.shared: index, self.turn = self.turn, (self.turn + 1) % count
+        else: index = (zlib.crc32(path) & 0xffffffff) % count
+        while index in self.dead: index = (index + 1) % count
+        if _debug: print 'passing connection for', path, 'to worker', self.workers[index][0]
+        yield self.queues[index].put((sock, path, received))
+
+    def sender(self, index):
+        '''Pass the queued connections to the worker, each as the file descriptor followed by the length and the bytes
+        received after handshake, and close them here. If the worker is dead, the connections are dispatched again.'''
+        from multiprocessing.reduction import send_handle
+        pid, channel = self.workers[index]
+        queue = self.queues[index]
+        while True:
+            item = yield queue.get()
+            if item is None: break
+            sock, path, received = item
+            try:
+                while index not in self.dead:
+                    try: send_handle(channel, sock.fileno(), pid); break
+                    except OSError, e:
+                        if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK: raise
+                    try: yield multitask.writable(channel, timeout=Acceptor.REAP_INTERVAL)
+                    except multitask.Timeout: pass # check again if the worker was reaped meanwhile
+            except EnvironmentError: # e.g., EPIPE if the worker is dead
+                if _debug: print 'rtmp.Acceptor.sender exception ', (sys and sys.exc_info() or None)
+                yield self.died(index)
+            if index in self.dead:
+                try: yield self.dispatch(sock, path, received)
+                except: Acceptor.close(sock)
+                continue
+            Acceptor.close(sock)
+            try:
+                data = struct.pack('>I', len(received)) + received
+                while data:
+                    sent = (yield multitask.send(channel, data))
+                    data = data[sent:]
+            except:
+                if _debug: print 'rtmp.Acceptor.sender exception ', (sys and sys.exc_info() or None)
+                yield self.died(index)
+        multitask.forget(channel); channel.close()
+
+    def died(self, index):
+        '''Route around the dead worker at index, and close the listening socket if no worker is left.'''
+        if index in self.dead: raise StopIteration
+        if _debug: print 'worker', self.workers[index][0], 'is dead'
+        self.dead.add(index)
+        if self.ringDir: StreamRing.cleanup(self.ringDir)
+        yield self.queues[index].put(None) # the sender dispatches the queued connections again and stops
+        if len(self.dead) == len(self.workers) and self.sock:
+            if _debug: print 'no worker left, closing listening socket'
+            try: multitask.forget(self.sock); self.sock.close(); self.sock = None
+            except: pass
+
+    def terminate(self):
+        '''Ask the live workers to exit, e.g., when this process exits.'''
+        for index, (pid, channel) in enumerate(self.workers):
+            if index not in self.dead:
+                try: os.kill(pid, signal.SIGTERM)
+                except OSError: pass
+
+    def reaper(self):
+        '''Check for the workers that have exited, until no worker is left.'''
+        while len(self.dead) < len(self.workers):
+            yield multitask.sleep(Acceptor.REAP_INTERVAL)
+            for index, (pid, channel) in enumerate(self.workers):
+                if index in self.dead: continue
+                try: result = os.waitpid(pid, os.WNOHANG)[0]
+                except OSError: result = pid # not our child any more
+                if result == pid: yield self.died(index)
+
+class GOPCache(object):
+    '''The media of a published live stream needed by a late joining player to start playing right away: the last metadata,
+    the AVC and AAC sequence headers, and all the messages since the last video keyframe. If the messages exceed maxSize
+    bytes, they are dropped and caching resumes at the next keyframe, or for an audio only stream the oldest are dropped.
+    Every cached message has an index, so that a player can catch up with the messages cached after its previous call.'''
+    def __init__(self, maxSize):
+        self.maxSize, self.metaData, self.avcSeq, self.aacSeq = maxSize, None, None, None
+        self.queue, self.first, self.size = [], 0, 0 # cached messages, index of the first one and their total bytes
+        self.video = self.keyframe = False # whether the stream has video, and whether the queue starts with a keyframe
+
+    def add(self, message):
+        '''Add a published message to the cache.'''
+        data = message.data
+        message = Message(message.header.dup(), data) # without the chunks of the players' copies, which maxSize does not count
+        if message.type == Message.DATA:
+            if 'onMetaData' in data[:32]: self.metaData = message; return
+        elif message.type == Message.VIDEO and data:
+            if data[:2] == '\x17\x00': self.avcSeq = message; return # AVC sequence header
+            self.video = True
+            if ord(data[0]) >> 4 == 1: # keyframe starts a new group of pictures
+                self.first, self.queue, self.size, self.keyframe = self.first + len(self.queue), [], 0, True
+        elif message.type == Message.AUDIO and data:
+            if ord(data[0]) >> 4 == 10 and data[1:2] == '\x00': self.aacSeq = message; return # AAC sequence header
+        else: return
+        if self.video and not self.keyframe: return # wait for the next keyframe
+        self.queue.append(message); self.size += len(data)
+        if self.size > self.maxSize:
+            if self.video:
+                self.first, self.queue, self.size, self.keyframe = self.first + len(self.queue), [], 0, False
+            else:
+                while self.size > self.maxSize: self.size -= len(self.queue.pop(0).data); self.first += 1
+
+    def messages(self, index=None):
+        '''Return a tuple (messages, index) with copies of the cached messages starting at the given index, and the index
+        to use for the next call. If index is None, the copies of metadata and sequence headers are first in the list with
+        their timestamps rebased to that of the first cached message, so that the player sees increasing timestamps.'''
+        result = [x.dup() for x in self.queue[max(0, (index or 0) - self.first):]]
+        if index is None:
+            headers = [x.dup() for x in (self.metaData, self.avcSeq, self.aacSeq) if x is not None]
+            if result:
+                for x in headers: x.time = result[0].time
+            result = headers + result
+        return (result, self.first + len(self.queue))
+
+class DVRBuffer(object):
+    '''The recent media of a published live stream for timeshifted play, i.e., the messages of the last maxDuration
+    millisec bounded by maxSize bytes, along with the last metadata and sequence headers as in GOPCache. The buffer always
+    starts with a keyframe, and the oldest messages are removed a group of pictures at a time, or for an audio only
+    stream a message at a time. The timestamp and index of each keyframe, or audio message of an audio only stream, in
+    the buffer is kept in keyTimes and keyIndexes. Like GOPCache, every buffered message has an index.'''
+    def __init__(self, maxDuration, maxSize):
+        self.maxDuration, self.maxSize, self.metaData, self.avcSeq, self.aacSeq = maxDuration, maxSize, None, None, None
+        self.queue, self.first, self.size = collections.deque(), 0, 0 # buffered messages, index of the first one and their total bytes
+        self.keyTimes, self.keyIndexes, self.video = [], [], False
+
+    @property
+    def edge(self):
+        '''The timestamp of the last buffered message, or None if empty.'''
+        return self.queue[-1].time if self.queue else None
+
+    def add(self, message):
+        '''Add a published message to the buffer, and remove the oldest messages beyond the limits.'''
+        data = message.data
+        message = Message(message.header.dup(), data) # without the chunks of the players' copies, which maxSize does not count
+        if message.type == Message.DATA:
+            if 'onMetaData' in data[:32]: self.metaData = message
+            return
+        elif message.type == Message.VIDEO and data:
+            if data[:2] == '\x17\x00': self.avcSeq = message; return # AVC sequence header
+            if not self.video: # only the keyframes are used to start playing once the stream has video
+                self.video, self.first, self.queue, self.size, self.keyTimes, self.keyIndexes = True, self.first + len(self.queue), collections.deque(), 0, [], []
+            start = ord(data[0]) >> 4 == 1
+        elif message.type == Message.AUDIO and data:
+            if ord(data[0]) >> 4 == 10 and data[1:2] == '\x00': self.aacSeq = message; return # AAC sequence header
+            start = not self.video
+        else: return
+        if start: self.keyTimes.append(message.time); self.keyIndexes.append(self.first + len(self.queue))
+        elif not self.keyIndexes: return # wait for the first keyframe
+        self.queue.append(message); self.size += len(data)
+        while len(self.keyIndexes) > 1 and (self.size > self.maxSize or message.time - self.keyTimes[1] >= self.maxDuration):
+            for i in xrange(self.keyIndexes[1] - self.first): self.size -= len(self.queue.popleft().data)
+            self.first = self.keyIndexes[1]; del self.keyTimes[0]; del self.keyIndexes[0]
+
+    def messages(self, index=None, start=None):
+        '''Return a tuple (messages, index) as in GOPCache.messages. If index is None, the messages start at the last
+        keyframe at or before the timestamp start, or the first buffered keyframe.'''
+        if index is None:
+            position = bisect.bisect_right(self.keyTimes, start) - 1 if start is not None else 0
+            index = self.keyIndexes[max(0, position)] if self.keyIndexes else self.first
+            result = [x.dup() for x in itertools.islice(self.queue, index - self.first, None)]
+            headers = [x.dup() for x in (self.metaData, self.avcSeq, self.aacSeq) if x is not None]
+            if result:
+                for x in headers: x.time = result[0].time
+            result = headers + result
+        else:
+            result = [x.dup() for x in itertools.islice(self.queue, max(0, index - self.first), None)]
+        return (result, self.first + len(self.queue))
+
+class StreamRing(object):
+    '''A ring buffer in a memory mapped file, in which the worker process of a published stream writes its messages for
+    the players in other worker processes of a multi-process FlashServer. The file has a header, slots for the last
+    metadata and AVC and AAC sequence headers, and then the ring of records, each with the sequence number, type, time and
+    size of a message followed by its data. A position in the ring only increases, and wraps around modulo the capacity.
+    Before each record the writer puts in the header the position up to which it is about to write, and after the record
+    the next position and sequence number, and the position and sequence number of the last video keyframe, or of the
+    end for a stream without keyframe yet. A reader that is more than the capacity behind, or finds an unexpected
+    sequence number, was overrun, and resyncs at the last keyframe. So is a reader whose copy of a record may have been
+    overwritten meanwhile, as per the position being written after the copy. The writer is created with the capacity,
+    and it raises ValueError if the file is in use by a live writer. The reader raises ValueError if the ring is closed
+    or its writer is gone. The file of a writer that is gone is removed by the next writer or reader, or by cleanup().'''
+    SIZE = 16777216 # bytes in the ring of each published stream
+    POLL_INTERVAL = 0.01 # seconds between reads of the ring by a reader
+    IDLE_TIMEOUT = 5 # seconds after which a reader without local players is closed
+    CHECK_INTERVAL = 1 # seconds between checks by a reader that the writer process is alive
+    MAGIC = 'RTMPRING'
+    HEADER = struct.Struct('>8sIIQQQQQQ') # magic, writer pid, closed, capacity, next position, next sequence, keyframe position, keyframe sequence, position being written up to
+    SLOT = struct.Struct('>IBII') # generation, odd while being written, type, time and size in a header slot
+    RECORD = struct.Struct('>QBII') # sequence, type, time and size of a record, or type 0 to wrap around
+    SLOT_SIZE, DATA = 65536, 4096 + 3 * 65536 # bytes of each of the three slots, and offset of the ring in the file
+    active = set() # writers that are not yet closed, so that their files are removed on exit
+
+    def __init__(self, path, capacity=None):
+        self.path, self.map, self.writer, self.overruns, self.dropped = path, None, capacity is not None, 0, 0
+        if capacity is None: # reader, which starts at the last keyframe
+            with open(path, 'rb') as fp: self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, pid, closed = StreamRing.HEADER.unpack_from(self.map, 0)[:3]
+            if magic != StreamRing.MAGIC or closed or not StreamRing.alive(pid):
+                self.map.close(); self.map = None; StreamRing.removeStale(path)
+                raise ValueError('Stream name not found')
+            self.pos = self.seq = None
+            self.checked = time.time()
+        else:
+            if os.path.exists(path) and not StreamRing.removeStale(path): # readers of a previous writer keep their own map
+                raise ValueError('Stream name already in use')
+            with open(path, 'w+b') as fp:
+                fp.truncate(StreamRing.DATA + capacity)
+                self.map = mmap.mmap(fp.fileno(), 0)
+            self.capacity, self.pos, self.seq, self.keyPos, self.keySeq, self.keyed = capacity, 0, 0, 0, 0, False
+            self.generations, self.closed, self.writing = [0, 0, 0], 0, 0
+            self._writeHeader()
+            StreamRing.active.add(self)
+
+    @staticmethod
+    def alive(pid):
+        try: os.kill(pid, 0); return True
+        except OSError, e: return e.errno == errno.EPERM
+
+    @staticmethod
+    def removeStale(path):
+        '''Remove the ring file if it is closed or its writer is gone, and return False if it is in use by a live writer.'''
+        try:
+            with open(path, 'rb') as fp:
+                magic, pid, closed = StreamRing.HEADER.unpack(fp.read(StreamRing.HEADER.size))[:3]
+                if magic == StreamRing.MAGIC and not closed and StreamRing.alive(pid): return False
+                if os.fstat(fp.fileno()).st_ino == os.stat(path).st_ino: os.remove(path) # unless replaced by a new writer
+        except (IOError, OSError, struct.error): pass
+        return True
+
+    @staticmethod
+    def cleanup(directory):
+        '''Remove the stale ring files in the directory, e.g., after a worker process is gone.'''
+        try: names = os.listdir(directory)
+        except OSError: return
+        for name in names:
+            if name.endswith('.ring'): StreamRing.removeStale(os.path.join(directory, name))
+
+    @staticmethod
+    def closeAll():
+        '''Close all the active writers, so that their files are removed, e.g., on exit.'''
+        for ring in list(StreamRing.active): ring.close()
+
+    def _writeHeader(self):
+        StreamRing.HEADER.pack_into(self.map, 0, StreamRing.MAGIC, os.getpid(), self.closed, self.capacity, self.pos, self.seq, self.keyPos, self.keySeq, self.writing)
+
+    def close(self):
+        '''For writer, mark the ring as closed and remove the file, and for reader, just unmap the file.'''
+        if self.map is None: return
+        if self.writer:
+            self.closed = 1; self._writeHeader()
+            StreamRing.active.discard(self)
+            try: os.remove(self.path)
+            except: pass
+        self.map.close(); self.map = None
+
+    def write(self, message):
+        '''For writer, append the message to the ring. The metadata and sequence headers are also kept in their slots for new
+        readers. A message larger than half the capacity is dropped.'''
+        data, type = message.data, message.type
+        slot = 0 if type == Message.DATA and 'onMetaData' in data[:32] else 1 if type == Message.VIDEO and FLV.isSequenceHeader(type, data) else 2 if FLV.isSequenceHeader(type, data) else None
+        if slot is not None and len(data) <= StreamRing.SLOT_SIZE - StreamRing.SLOT.size: # seqlock with odd generation while writing
+            offset, generation = StreamRing.DATA - (3 - slot) * StreamRing.SLOT_SIZE, self.generations[slot]
+            StreamRing.SLOT.pack_into(self.map, offset, generation + 1, type, message.time & 0xFFFFFFFF, len(data))
+            self.map[offset+StreamRing.SLOT.size:offset+StreamRing.SLOT.size+len(data)] = data
+            StreamRing.SLOT.pack_into(self.map, offset, generation + 2, type, message.time & 0xFFFFFFFF, len(data))
+            self.generations[slot] = generation + 2
+        need = StreamRing.RECORD.size + len(data)
+        if need > self.capacity / 2: self.dropped += 1; return
+        offset = self.pos % self.capacity
+        self.writing = self.pos + need if self.capacity - offset >= need else self.pos + self.capacity - offset + need
+        self._writeHeader() # before overwriting, so that a reader can tell if its copy is intact
+        if self.capacity - offset < need: # wrap around to the start of the ring
+            if self.capacity - offset >= StreamRing.RECORD.size: StreamRing.RECORD.pack_into(self.map, StreamRing.DATA + offset, self.seq, 0, 0, 0)
+            self.pos, offset = self.pos + self.capacity - offset, 0
+        if type == Message.VIDEO and FLV.isKeyframe(data):
+            self.keyPos, self.keySeq, self.keyed = self.pos, self.seq, True
+        start = StreamRing.DATA + offset + StreamRing.RECORD.size
+        StreamRing.RECORD.pack_into(self.map, StreamRing.DATA + offset, self.seq, type, message.time & 0xFFFFFFFF, len(data))
+        self.map[start:start+len(data)] = data
+        self.pos, self.seq = self.pos + need, self.seq + 1
+        if not self.keyed: self.keyPos, self.keySeq = self.pos, self.seq # new readers start at the end, after the slots
+        self._writeHeader()
+
+    def read(self):
+        '''For reader, return a tuple (messages, closed) with the messages written since the previous read, and whether the
+        writer has closed the ring after them, or is gone as checked every CHECK_INTERVAL seconds. The first read starts
+        with the messages in the slots.'''
+        messages, map = [], self.map
+        magic, pid, closed, capacity, pos, seq, keyPos, keySeq, writing = StreamRing.HEADER.unpack_from(map, 0)
+        if not closed and time.time() - self.checked >= StreamRing.CHECK_INTERVAL:
+            self.checked = time.time()
+            if not StreamRing.alive(pid): closed = 1; StreamRing.removeStale(self.path)
+        if self.pos is None:
+            messages.extend(self._slots())
+            self.pos, self.seq = keyPos, keySeq
+        while self.pos < pos:
+            if pos - self.pos > capacity: self._resync(); continue
+            offset = self.pos % capacity
+            if capacity - offset < StreamRing.RECORD.size: self.pos += capacity - offset; continue
+            rseq, type, tm, size = StreamRing.RECORD.unpack_from(map, StreamRing.DATA + offset)
+            if type == 0: self.pos += capacity - offset; continue
+            if rseq != self.seq: self._resync(); continue
+            start = StreamRing.DATA + offset + StreamRing.RECORD.size
+            data = map[start:start+size]
+            if StreamRing.HEADER.unpack_from(map, 0)[8] - self.pos > capacity: self._resync(); continue # overwritten while copying
+            messages.append(Message(Header(0, tm, size, type, 0), data))
+            self.pos, self.seq = self.pos + StreamRing.RECORD.size + size, self.seq + 1
+        return (messages, bool(closed) and self.pos >= pos)
+
+    def _resync(self):
+        '''For reader, continue from the last keyframe after an overrun, or from the end if that is also overwritten.'''
+        capacity, pos, seq, keyPos, keySeq, writing = StreamRing.HEADER.unpack_from(self.map, 0)[3:]
+        self.pos, self.seq = (keyPos, keySeq) if writing - keyPos <= capacity else (pos, seq)
+        self.overruns += 1
+        if _debug: print 'StreamRing overrun', self.overruns, 'resync at', self.pos
+
+    def _slots(self):
+        result = []
+        for slot in xrange(3):
+            offset = StreamRing.DATA - (3 - slot) * StreamRing.SLOT_SIZE
+            for retry in xrange(3):
+                generation, type, time, size = StreamRing.SLOT.unpack_from(self.map, offset)
+                if generation == 0 or generation % 2: continue # not written, or being written
+                data = self.map[offset+StreamRing.SLOT.size:offset+StreamRing.SLOT.size+size]
+                if StreamRing.SLOT.unpack_from(self.map, offset)[0] == generation:
+                    result.append(Message(Header(0, time, size, type, 0), data)); break
+        return result
+
+atexit.register(StreamRing.closeAll)
+
+class RemotePlayers(Stream):
+    '''The players in other worker processes of a stream published in this process. It is in App.players like a local
+    player, so that mediahandler sends it the published messages, which it writes to the StreamRing of the publisher.'''
+    def __init__(self, publisher):
+        Stream.__init__(self, publisher.client)
+        self.name, self.publisher = publisher.name, publisher
+
+    def send(self, msg, live=False):
+        if self.publisher.ring is not None and isinstance(msg, Message) and (msg.type == Message.AUDIO or msg.type == Message.VIDEO or msg.type == Message.DATA):
+            self.publisher.ring.write(msg)
+        yield
+
+class RemoteClient(object):
+    '''The placeholder client of a RemotePublisher, with just the app path, since the real client is in another process.'''
+    def __init__(self, path):
+        self.path, self.agent, self.streams = path, None, {}
+
+class RemotePublisher(Stream):
+    '''A stream published in another worker process. It is in App.publishers like a local publisher, so that the local
+    players join it as usual, and FlashServer.ringhandler reads the messages from its StreamRing and handles them as
+    mediahandler does for a local publisher.'''
+    def __init__(self, path, name, ring):
+        Stream.__init__(self, RemoteClient(path))
+        self.name, self.mode, self.ring = name, 'live', ring
+
 class App(object):
     '''An application instance containing any number of streams. Except for constructor all methods are generators.'''
     count = 0
+    gopCacheSize = 4194304 # maximum bytes in GOPCache of each published stream, or 0 to disable it
+    chunkSize = None # write chunk size for the clients of this application, or None to use that of the FlashServer
+    dvrDuration, dvrSize = 0, 67108864 # seconds and maximum bytes in DVRBuffer of each published stream for timeshift, or 0 seconds to disable it
+    segmentDuration = segmentSize = 0 # seconds or bytes of each SegmentedFLV file for record and append, or 0 to record one file
     def __init__(self):
         self.name = str(self.__class__.__name__) + '[' + str(App.count) + ']'; App.count += 1
         self.players, self.publishers, self._clients = {}, {}, [] # Streams indexed by stream name, and list of clients
@@ -995,10 +2166,13 @@ class App(object):
     def getfile(self, path, name, root, mode):
         if mode == 'play':
             path = getfilename(path, name, root)
-            if not os.path.exists(path): return None
+            if not os.path.exists(path):
+                if os.path.exists(SegmentedFLV.manifestName(path)): return SegmentedFLV().open(path)
+                return None
             return FLV().open(path)
         elif mode in ('record', 'append'):
             path = getfilename(path, name, root)
+            if self.segmentDuration or self.segmentSize: return SegmentedFLV(self.segmentDuration, self.segmentSize).open(path, mode)
             return FLV().open(path, mode)
 #        elif stream.mode == 'live': FLV().delete(path) # TODO: this is commented out to avoid accidental delete
         return None
@@ -1057,6 +2231,8 @@ class FlashServer(object):
         self.apps = dict({'*': App, 'wirecast': Wirecast}) # supported applications: * means any as in {'*': App}
         self.clients = dict()  # list of clients indexed by scope. First item in list is app instance.
         self.root = '';
+        self.chunkSize = Protocol.HIGH_WRITE_CHUNK_SIZE # write chunk size sent to the clients after connect, unless the App has chunkSize
+        self.shared, self.ringDir = set(), None # app names or paths of scopes spread across the workers, and directory of their StreamRing files
 
     def start(self, host='0.0.0.0', port=1935):
         '''This should be used to start listening for RTMP connections on the given port, which defaults to 1935.'''
@@ -1069,6 +2245,45 @@ class FlashServer(object):
             self.server = Server(sock) # start rtmp server on that socket
             multitask.add(self.serverlistener())
 
+    def startWorkers(self, host='0.0.0.0', port=1935, count=2):
+        '''Fork count worker processes, each serving the connections passed by the Acceptor in this process, which listens on
+        the given port. Returns True in a worker process, and False in this process. The application instances of a scope
+        are in the worker owning its app path, hence all the processes can be used for different scopes. The clients of the
+        scopes in shared are spread across the workers instead, and the published streams reach the players in other workers
+        using a StreamRing in ringDir. All the processes exit on SIGTERM as on sys.exit, so that the exit handlers remove
+        the ring files and ringDir, and the workers are terminated when this process exits.'''
+        workers = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if self.shared: self.ringDir = tempfile.mkdtemp(prefix='rtmplite-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        for i in xrange(count):
+            parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            pid = os.fork()
+            if pid == 0: # in the worker, close the UNIX sockets of the other workers
+                parent.close()
+                for ignore, other in workers: other.close()
+                self.server = WorkerServer(child)
+                multitask.add(self.serverlistener())
+                if self.shared: multitask.add(self.ringlistener())
+                return True
+            child.close()
+            workers.append((pid, parent))
+        sock = self.sock = socket.socket(type=socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        if _debug: print 'listening on ', sock.getsockname(), 'with', count, 'workers'
+        sock.listen(5)
+        self.server = Acceptor(sock, workers, self.shared, self.ringDir)
+        if self.ringDir: atexit.register(shutil.rmtree, self.ringDir, True)
+        atexit.register(self.server.terminate) # before removing ringDir
+        return False
+
+    def isShared(self, path):
+        '''Whether the scope of the app path is spread across the workers.'''
+        return self.ringDir is not None and (path in self.shared or path.partition('/')[0] in self.shared)
+
+    def ringName(self, path, name):
+        return os.path.join(self.ringDir, hashlib.sha1((path + '/' + name).encode('utf-8')).hexdigest() + '.ring')
+
     def stop(self):
         if _debug: print 'stopping Flash server'
         if self.server and self.sock:
@@ -1103,6 +2318,12 @@ class FlashServer(object):
                         if client.path in self.clients: inst = self.clients[client.path][0]
                         else: inst = app()
 
+                        chunkSize = inst.chunkSize or self.chunkSize
+                        if chunkSize != client.writeChunkSize: # so that the connect response and the following messages use fewer chunks
+                            set_chunk_size = Message()
+                            set_chunk_size.time, set_chunk_size.type, set_chunk_size.data = client.relativeTime, Message.CHUNK_SIZE, struct.pack('>L', chunkSize)
+                            yield client.writeMessage(set_chunk_size)
+
                         win_ack = Message()
                         win_ack.time, win_ack.type, win_ack.data = client.relativeTime, Message.WIN_ACK_SIZE, struct.pack('>L', client.writeWinSize)
                         yield client.writeMessage(win_ack)
@@ -1174,6 +2395,10 @@ class FlashServer(object):
             if stream.name in inst.publishers and inst.publishers[stream.name] == stream: # clear the published stream
                 inst.onClose(stream.client, stream)
                 del inst.publishers[stream.name]
+                for remote in [x for x in inst.players.get(stream.name, []) if isinstance(x, RemotePlayers)]:
+                    inst.onStop(stream.client, remote)
+                    inst.players[stream.name].remove(remote); remote.close()
+                if stream.name in inst.players and not inst.players[stream.name]: del inst.players[stream.name]
             if stream.name in inst.players and stream in inst.players[stream.name]:
                 inst.onStop(stream.client, stream)
                 inst.players[stream.name].remove(stream)
@@ -1234,6 +2459,10 @@ class FlashServer(object):
                     self.closehandler(stream)
                 elif cmd.name == 'seek':
                     yield self.seekhandler(stream, cmd)
+                elif cmd.name == 'receiveAudio' or cmd.name == 'receiveVideo':
+                    self.receivehandler(stream, cmd)
+                elif cmd.name == 'pause' or cmd.name == 'pauseRaw':
+                    yield self.pausehandler(stream, cmd)
             else: # audio or video message
                 yield self.mediahandler(stream, message)
         except GeneratorExit: pass
@@ -1251,8 +2480,16 @@ class FlashServer(object):
             inst = self.clients[stream.client.path][0]
             if (stream.name in inst.publishers):
                 raise ValueError, 'Stream name already in use'
+            if self.isShared(stream.client.path): # also for the players in other workers, unless published in another worker
+                stream.ring = StreamRing(self.ringName(stream.client.path, stream.name), StreamRing.SIZE)
             inst.publishers[stream.name] = stream # store the client for publisher
+            stream.gopCache = GOPCache(inst.gopCacheSize) if inst.gopCacheSize else None
+            stream.dvr = DVRBuffer(inst.dvrDuration * 1000, inst.dvrSize) if inst.dvrDuration else None
             inst.onPublish(stream.client, stream)
+            if stream.ring is not None:
+                remote = RemotePlayers(stream)
+                inst.onPlay(stream.client, remote)
+                inst.players.setdefault(stream.name, []).append(remote)
 
             stream.recordfile = inst.getfile(stream.client.path, stream.name, self.root, stream.mode)
             response = Command(name='onStatus', id=cmd.id, tm=stream.client.relativeTime, args=[amf.Object(level='status', code='NetStream.Publish.Start', description='', details=None)])
@@ -1267,29 +2504,32 @@ class FlashServer(object):
         try:
             inst = self.clients[stream.client.path][0]
             name = stream.name = cmd.args[0]  # store the stream's name
-            if stream.name and '?' in stream.name: name = stream.name = stream.name.partition('?')[0]
+            if stream.name and '?' in stream.name:
+                name, ignore, query = stream.name.partition('?'); stream.name = name
+                if 'keyframes' in [x.partition('=')[0] for x in query.split('&')]: # e.g., for thumbnails, without audio unless asked
+                    stream.keyframesOnly, stream.receiveAudio = True, False
             start = cmd.args[1] if len(cmd.args) >= 2 else -2
-            if name not in inst.players:
-                inst.players[name] = [] # initialize the players for this stream name
-            if stream not in inst.players[name]: # store the stream as players of this name
-                inst.players[name].append(stream)
-            task = None
-            if start >= 0 or start == -2 and name not in inst.publishers:
+            publisher, cache, shift, task = inst.publishers.get(name, None), None, None, None
+            if publisher is None and self.isShared(stream.client.path): publisher = self.remotePublisher(inst, stream.client.path, name)
+            dvr = publisher and publisher.dvr
+            if start >= 0 or start == -2 and publisher is None:
                 stream.playfile = inst.getfile(stream.client.path, stream.name, self.root, 'play')
                 if stream.playfile:
                     if start > 0: stream.playfile.seek(start)
                     task = stream.playfile.reader(stream)
-                elif start >= 0: raise ValueError, 'Stream name not found'
+                elif start >= 0 and dvr is None: raise ValueError, 'Stream name not found'
+            if task is None and publisher is not None: # a late joining live player is added to players after the cache is sent
+                if dvr is not None and (start >= 0 or start < -2): # timeshift to the timestamp start, or -start millisec before the live edge
+                    cache, shift = dvr, start if start >= 0 else (dvr.edge or 0) + start
+                else:
+                    cache = publisher.gopCache
+            if name not in inst.players:
+                inst.players[name] = [] # initialize the players for this stream name
+            if cache is None and stream not in inst.players[name]: # store the stream as players of this name
+                inst.players[name].append(stream)
             if _debug: print 'playing stream=', name, 'start=', start
             inst.onPlay(stream.client, stream)
 
-            # Default chunk size is 128. It is pretty small when we stream high audio and video quality.
-            # So, send the choosen chunk size to flash client.
-            stream.client.writeChunkSize = Protocol.HIGH_WRITE_CHUNK_SIZE
-            m0 = Message() # SetChunkSize
-            m0.time, m0.type, m0.data = stream.client.relativeTime, Message.CHUNK_SIZE, struct.pack('>L', stream.client.writeChunkSize)
-            yield stream.client.writeMessage(m0)
-
 #            m1 = Message() # UserControl/StreamIsRecorded
 #            m1.time, m1.type, m1.data = stream.client.relativeTime, Message.USER_CONTROL, struct.pack('>HI', 4, stream.id)
 #            yield stream.client.writeMessage(m1)
@@ -1308,11 +2548,47 @@ class FlashServer(object):
 #            yield stream.send(response)
 
             if task is not None: multitask.add(task)
+            elif cache is not None: yield self.bursthandler(inst, stream, cache, shift)
         except ValueError, E: # some error occurred. inform the app.
             if _debug: print 'error in playing stream', str(E)
             response = Command(name='onStatus', id=cmd.id, tm=stream.client.relativeTime, args=[amf.Object(level='error',code='NetStream.Play.StreamNotFound',description=str(E),details=None)])
             yield stream.send(response)
 
+    def bursthandler(self, inst, stream, cache, start=None):
+        '''Send the GOPCache of the published stream to a late joining live player, and then add it to the players of the
+        stream. Messages published while the cache is being sent are sent next, so that none is lost or sent twice. For
+        timeshift, the cache is the DVRBuffer of the stream and the messages start at the timestamp start.'''
+        messages, index = cache.messages() if start is None else cache.messages(start=start)
+        while messages and stream.client is not None:
+            if _debug: print 'bursting', len(messages), 'cached messages to', stream
+            for m in messages:
+                if inst.onPlayData(stream.client, stream, m): yield stream.send(m)
+            messages, index = cache.messages(index)
+        if stream.client is not None: # joins the live fan out in mediahandler, without yielding after the last check
+            players = inst.players.setdefault(stream.name, [])
+            if stream not in players: players.append(stream)
+
+    def receivehandler(self, stream, cmd):
+        '''The player turns the audio or video of the stream on or off. Video turned on is sent from the next keyframe.'''
+        flag = bool(cmd.args[0]) if cmd.args else True
+        if _debug: print cmd.name, flag, 'stream=', stream.name
+        if cmd.name == 'receiveAudio': stream.receiveAudio = flag
+        else:
+            if flag and not stream.receiveVideo: stream.waitKeyframe = True
+            stream.receiveVideo = flag
+
+    def pausehandler(self, stream, cmd):
+        '''The player pauses or resumes the stream. The reader of a file is suspended while paused, whereas live media is not
+        sent to the paused player, and is sent from the next keyframe when resumed.'''
+        paused = bool(cmd.args[0]) if cmd.args else not stream.paused
+        if _debug: print 'pause', paused, 'stream=', stream.name
+        if paused != stream.paused:
+            stream.paused = paused
+            if stream.playfile is not None and stream.playfile.type == 'read': yield stream.playfile.pause(paused)
+            elif not paused: stream.waitKeyframe = True
+        response = Command(name='onStatus', id=cmd.id, tm=stream.client.relativeTime, args=[amf.Object(level='status', code='NetStream.Pause.Notify' if paused else 'NetStream.Unpause.Notify', description=stream.name, details=None)])
+        yield stream.send(response)
+
     def seekhandler(self, stream, cmd):
         '''A stream is seeked to a new position. This is allowed only for play from a file.'''
         try:
@@ -1327,18 +2603,62 @@ class FlashServer(object):
             response = Command(name='onStatus', id=cmd.id, tm=stream.client.relativeTime, args=[amf.Object(level='error',code='NetStream.Seek.Failed',description=str(E),details=None)])
             yield stream.send(response)
 
+    def remotePublisher(self, inst, path, name):
+        '''Return a new RemotePublisher for the stream name if it is published in another worker, or None.'''
+        try: ring = StreamRing(self.ringName(path, name))
+        except (IOError, OSError, ValueError): return None
+        stream = RemotePublisher(path, name, ring)
+        stream.gopCache = GOPCache(inst.gopCacheSize) if inst.gopCacheSize else None
+        stream.dvr = DVRBuffer(inst.dvrDuration * 1000, inst.dvrSize) if inst.dvrDuration else None
+        inst.publishers[name] = stream
+        inst.onPublish(stream.client, stream)
+        multitask.add(self.ringhandler(inst, stream))
+        return stream
+
+    def ringhandler(self, inst, stream):
+        '''Read the messages of the RemotePublisher from its StreamRing, and handle them as mediahandler does for a local
+        publisher, until the ring is closed by the publisher, or no local player is left for IDLE_TIMEOUT seconds.'''
+        idle = 0
+        try:
+            while stream.client is not None and self.clients.get(stream.client.path, [None])[0] is inst:
+                messages, closed = stream.ring.read()
+                for message in messages: yield self.mediahandler(stream, message)
+                if closed: break
+                idle = 0 if inst.players.get(stream.name) else idle + StreamRing.POLL_INTERVAL
+                if idle >= StreamRing.IDLE_TIMEOUT: break
+                yield multitask.sleep(StreamRing.POLL_INTERVAL)
+        except:
+            if _debug: print 'ringhandler exception', (sys and sys.exc_info() or None)
+        if _debug: print 'closing remote publisher', stream.name
+        if inst.publishers.get(stream.name, None) is stream:
+            inst.onClose(stream.client, stream)
+            del inst.publishers[stream.name]
+        stream.close()
+
+    def ringlistener(self):
+        '''In a worker, check once in a while for the streams published in other workers that local players are waiting for.'''
+        while True:
+            yield multitask.sleep(1)
+            for path, clients in self.clients.items():
+                if self.isShared(path):
+                    inst = clients[0]
+                    for name in [x for x in inst.players.keys() if x not in inst.publishers]: self.remotePublisher(inst, path, name)
+
     def mediahandler(self, stream, message):
         '''Handle incoming media on the stream, by sending to other stream in this application instance.'''
         if stream.client is not None:
             inst = self.clients[stream.client.path][0]
             result = inst.onPublishData(stream.client, stream, message)
             if result:
+                message.chunks = {} # so that the copies for all the players are chunked only once per chunk size and channel
+                if stream.gopCache is not None: stream.gopCache.add(message)
+                if stream.dvr is not None: stream.dvr.add(message)
                 for s in (inst.players.get(stream.name, [])):
                     #if _debug: print 'D', stream.name, s.name
                     m = message.dup()
                     result = inst.onPlayData(s.client, s, m)
                     if result:
-                        yield s.send(m)
+                        yield s.send(m, live=True)
                 if stream.recordfile is not None:
                     stream.recordfile.write(message)
 
@@ -1349,14 +2669,40 @@ if __name__ == '__main__':
     parser.add_option('-i', '--host',    dest='host',    default='0.0.0.0', help="listening IP address. Default '0.0.0.0'")
     parser.add_option('-p', '--port',    dest='port',    default=1935, type="int", help='listening port number. Default 1935')
     parser.add_option('-r', '--root',    dest='root',    default='./',       help="document path prefix. Directory must end with /. Default './'")
+    parser.add_option('-k', '--chunk-size', dest='chunkSize', default=Protocol.HIGH_WRITE_CHUNK_SIZE, type="int", help='RTMP chunk size of the messages sent to clients, which is set right after connect. Default %d'%(Protocol.HIGH_WRITE_CHUNK_SIZE,))
+    parser.add_option('-g', '--gop-cache', dest='gopCacheSize', default=App.gopCacheSize, type="int", help='maximum bytes of media cached per live stream for late joining players, 0 to disable. Default %d'%(App.gopCacheSize,))
+    parser.add_option('-c', '--vod-cache', dest='vodCacheSize', default=FLV.cache.maxBytes, type="int", help='maximum bytes of FLV files cached for playback and shared by all players. Default %d'%(FLV.cache.maxBytes,))
+    parser.add_option('-f', '--fast-start', dest='fastStart', default=None, type="int", help="millisec of media sent ahead of real time on file play or seek. Default is the client's buffer time")
+    parser.add_option('--flush-interval', dest='flushInterval', default=FLVWriter.FLUSH_INTERVAL, type="float", help='seconds between writes of buffered recording to disk. Default %r'%(FLVWriter.FLUSH_INTERVAL,))
+    parser.add_option('--flush-size', dest='flushSize', default=FLVWriter.FLUSH_SIZE, type="int", help='bytes of buffered recording that are written to disk without waiting for flush interval. Default %d'%(FLVWriter.FLUSH_SIZE,))
+    parser.add_option('--write-buffer', dest='writeBuffer', default=FLVWriter.MAX_PENDING, type="int", help='maximum bytes of recording not yet written to disk, for each file. Default %d'%(FLVWriter.MAX_PENDING,))
+    parser.add_option('--backpressure', dest='backpressure', default=FLVWriter.POLICY, choices=('drop', 'block'), help="what to do when the write buffer is full, drop media or block the server. Default '%s'"%(FLVWriter.POLICY,))
+    parser.add_option('--dvr', dest='dvrDuration', default=App.dvrDuration, type="int", help='seconds of media kept in memory per live stream for timeshifted play, 0 to disable. Default %d'%(App.dvrDuration,))
+    parser.add_option('--dvr-size', dest='dvrSize', default=App.dvrSize, type="int", help='maximum bytes of media kept in memory per live stream for timeshifted play. Default %d'%(App.dvrSize,))
+    parser.add_option('--segment-duration', dest='segmentDuration', default=App.segmentDuration, type="int", help='seconds after which recording continues in a new segment file on a keyframe, 0 to not use. Default %d'%(App.segmentDuration,))
+    parser.add_option('--segment-size', dest='segmentSize', default=App.segmentSize, type="int", help='bytes after which recording continues in a new segment file on a keyframe, 0 to not use. Default %d'%(App.segmentSize,))
+    parser.add_option('--queue-size', dest='queueSize', default=Protocol.MAX_QUEUE_BYTES, type="int", help='bytes of live media queued for a player beyond which it is slow. Default %d'%(Protocol.MAX_QUEUE_BYTES,))
+    parser.add_option('--queue-delay', dest='queueDelay', default=Protocol.MAX_QUEUE_DELAY, type="float", help='seconds of live media queued for a player beyond which it is slow. Default %r'%(Protocol.MAX_QUEUE_DELAY,))
+    parser.add_option('--slow-player', dest='slowPlayer', default=Protocol.QUEUE_POLICY, choices=('drop', 'queue'), help="what to do with live video for a slow player, drop frames up to the next keyframe or queue all. Default '%s'"%(Protocol.QUEUE_POLICY,))
+    parser.add_option('-w', '--workers', dest='workers', default=0, type="int", help='number of worker processes, each owning the app paths routed to it, 0 to serve all in this process. Default 0')
+    parser.add_option('--shared', dest='shared', default='', help='comma separated app names or paths whose clients are spread across the worker processes, with published streams shared in memory. Default none')
+    parser.add_option('--ring-size', dest='ringSize', default=StreamRing.SIZE, type="int", help='bytes of shared memory for each published stream of the shared app names. Default %d'%(StreamRing.SIZE,))
     parser.add_option('-d', '--verbose', dest='verbose', default=False, action='store_true', help='enable debug trace')
     (options, args) = parser.parse_args()
 
     _debug = options.verbose
+    App.gopCacheSize, App.segmentDuration, App.segmentSize = options.gopCacheSize, options.segmentDuration, options.segmentSize
+    App.dvrDuration, App.dvrSize = options.dvrDuration, options.dvrSize
+    FLV.cache.maxBytes = options.vodCacheSize
+    FLV.FAST_START = options.fastStart
+    FLVWriter.FLUSH_INTERVAL, FLVWriter.FLUSH_SIZE, FLVWriter.MAX_PENDING, FLVWriter.POLICY = options.flushInterval, options.flushSize, options.writeBuffer, options.backpressure
+    Protocol.MAX_QUEUE_BYTES, Protocol.MAX_QUEUE_DELAY, Protocol.QUEUE_POLICY = options.queueSize, options.queueDelay, options.slowPlayer
     try:
         agent = FlashServer()
-        agent.root = options.root
-        agent.start(options.host, options.port)
+        agent.root, agent.chunkSize = options.root, options.chunkSize
+        agent.shared, StreamRing.SIZE = set([x for x in options.shared.split(',') if x]), options.ringSize
+        if options.workers: agent.startWorkers(options.host, options.port, options.workers)
+        else: agent.start(options.host, options.port)
         if _debug: print time.asctime(), 'Flash Server Starts - %s:%d' % (options.host, options.port)
         multitask.run()
     except KeyboardInterrupt:
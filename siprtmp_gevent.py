@@ -79,8 +79,9 @@ class Stream(object):
         
 class FlashClient(object):
     '''Represents a single Flash connection and client.'''
-    PING_SIZE, DEFAULT_CHUNK_SIZE, HIGH_WRITE_CHUNK_SIZE, PROTOCOL_CHANNEL_ID = 1536, 128, 4096, 2 # constants
-    READ_WIN_SIZE, WRITE_WIN_SIZE = 1000000L, 1073741824L
+    PING_SIZE, DEFAULT_CHUNK_SIZE, HIGH_WRITE_CHUNK_SIZE, PROTOCOL_CHANNEL_ID = 1536, 128, 65536, 2 # constants
+    READ_WIN_SIZE, WRITE_WIN_SIZE = 1000000L, 2500000L
+    MAX_UNACKED_WINDOWS = 2 # drop media when unacked bytes exceed these many windows, as in rtmp.Protocol.windowFull
     CHANNEL_MASK = 0x3F
 
     
@@ -93,10 +94,13 @@ class FlashClient(object):
         self.server, self.sock, self.state, self.buffer = server, sock, 'idle', ''
         self.bytesRead = self.bytesWritten = 0
         self.lastReadHeaders, self.incompletePackets, self.lastWriteHeaders = dict(), dict(), dict()
+        self.incompleteBytes = 0 # total bytes held in incompletePackets
         self.readChunkSize = self.writeChunkSize = self.DEFAULT_CHUNK_SIZE
         self.readWinSize0, self.readWinSize, self.writeWinSize0, self.writeWinSize = 0L, self.READ_WIN_SIZE, 0L, self.WRITE_WIN_SIZE
+        self.bufferTimes = dict() # buffer time in millisec set by the client, indexed by stream id
         self.nextChannelId = self.PROTOCOL_CHANNEL_ID + 1
         self._time0 = time.time()
+        self.acked, self.skipVideo, self.windowDrops = False, False, 0 # whether peer sends ACK, skip video until keyframe
         self.path, self.agent, self.streams, self._nextCallId, self._nextStreamId, self.objectEncoding, self._rpc = \
           None,      None,         {},           2,                1,                  0.0,             Message.RPC
         self._write_lock = Semaphore()
@@ -105,11 +109,23 @@ class FlashClient(object):
     def relativeTime(self):
         return int(1000*(time.time() - self._time0))
     
+    @property
+    def unackedBytes(self):
+        '''Number of bytes written but not yet acknowledged by the peer, or 0 if the peer never sent an ACK.'''
+        if not self.acked: return 0
+        unacked = (self.bytesWritten - self.writeWinSize0) & 0xFFFFFFFF
+        return unacked if unacked < 0x80000000 else 0
+    
+    @property
+    def windowFull(self):
+        return self.unackedBytes >= self.MAX_UNACKED_WINDOWS * self.writeWinSize
+    
     def send(self, data):
         if self.sock is not None and data is not None:
             self._write_lock.acquire()
             try:
                 self.sock.sendall(data)
+                self.bytesWritten += len(data)
             except:
                 if _debug: traceback.print_exc()
             finally:
@@ -178,13 +194,14 @@ class FlashClient(object):
 
                 # if _debug: print 'R', header, header.currentTime, header.extendedTime, '0x%x'%(hdrsize,)
              
-                data = self.incompletePackets.get(channel, '') # are we continuing an incomplete packet?
+                packet = self.incompletePackets.get(channel, None) # are we continuing an incomplete packet?
+                received = packet[0] if packet is not None else 0
             
-                count = min(header.size - (len(data)), self.readChunkSize) # how much more
+                count = min(header.size - received, self.readChunkSize) # how much more
                 
                 if size < offset+count: return
                 
-                data, offset = data + buffer[offset:offset+count], offset+count
+                data, offset = buffer[offset:offset+count], offset+count
                 if size == offset:
                     self.buffer = ''
                 else:
@@ -198,19 +215,22 @@ class FlashClient(object):
                         ack.time, ack.type, ack.data = self.relativeTime, Message.ACK, struct.pack('>L', self.readWinSize0)
                         self.writeMessage(ack)
                     
-                if len(data) < header.size: # we don't have all data
-                    self.incompletePackets[channel] = data
+                if received + count < header.size: # we don't have all data
+                    if packet is None: packet = self.incompletePackets[channel] = [0, []] # bytes received and list of chunks
+                    packet[0] += count; packet[1].append(data)
+                    self.incompleteBytes += count
+                    if self.incompleteBytes > Protocol.MAX_INCOMPLETE_BYTES:
+                        raise ValueError, 'incomplete messages exceed %d bytes'%(Protocol.MAX_INCOMPLETE_BYTES,)
                 else: # we have all data
                     if hdrtype in (Header.MESSAGE, Header.TIME):
                         header.currentTime = header.currentTime + (header.extendedTime or header.time)
                     elif hdrtype == Header.SEPARATOR:
                         if header.hdrtype in (Header.MESSAGE, Header.TIME):
                             header.currentTime = header.currentTime + (header.extendedTime or header.time)
-                    if len(data) == header.size:
-                        if channel in self.incompletePackets:
-                            del self.incompletePackets[channel]
-                    else:
-                        data, self.incompletePackets[channel] = data[:header.size], data[header.size:]
+                    if packet is not None: # join the chunks only once when the message is complete
+                        del self.incompletePackets[channel]
+                        self.incompleteBytes -= packet[0]
+                        packet[1].append(data); data = ''.join(packet[1])
                 
                     hdr = Header(channel=header.channel, time=header.currentTime, size=header.size, type=header.type, streamId=header.streamId)
                     msg = Message(hdr, data)
@@ -225,32 +245,46 @@ class FlashClient(object):
             if stream is not None:
                 message.streamId = stream.id
             
-            # get the header stored for the stream
-            if self.lastWriteHeaders.has_key(message.streamId):
-                header = self.lastWriteHeaders[message.streamId]
+            # media is written by the publisher's greenlet, hence it is dropped instead of waiting for the send window
+            if message.type == Message.VIDEO or message.type == Message.AUDIO:
+                if self.windowFull:
+                    self.skipVideo, self.windowDrops = True, self.windowDrops + 1
+                    return
+                if message.type == Message.VIDEO and self.skipVideo:
+                    if not message.data or ord(message.data[0]) & 0xF0 != 0x10: self.windowDrops += 1; return # not a keyframe
+                    self.skipVideo = False
+            
+            # get the header stored for the stream and type, as in rtmp.Protocol.writeChunks
+            key = (message.streamId, message.type)
+            if self.lastWriteHeaders.has_key(key):
+                header = self.lastWriteHeaders[key]
             else:
                 if self.nextChannelId <= self.PROTOCOL_CHANNEL_ID: 
                     self.nextChannelId = self.PROTOCOL_CHANNEL_ID+1
                 header, self.nextChannelId = Header(self.nextChannelId), self.nextChannelId + 1
-                self.lastWriteHeaders[message.streamId] = header
+                self.lastWriteHeaders[key] = header
             if message.type < Message.AUDIO:
                 header = Header(self.PROTOCOL_CHANNEL_ID)
                
             # now figure out the header data bytes
-            if header.streamId != message.streamId or header.time == 0 or message.time <= header.time:
+            if header.type is None or header.streamId != message.streamId or message.time < header.time:
                 header.streamId, header.type, header.size, header.time, header.delta = message.streamId, message.type, message.size, message.time, message.time
                 control = Header.FULL
             elif header.size != message.size or header.type != message.type:
                 header.type, header.size, header.time, header.delta = message.type, message.size, message.time, message.time-header.time
                 control = Header.MESSAGE
+            elif header.hdrtype != Header.FULL and message.time - header.time == header.delta and header.delta < 0xFFFFFF:
+                header.time = message.time
+                control = Header.SEPARATOR # the receiver adds the previous delta
             else:
                 header.time, header.delta = message.time, message.time-header.time
                 control = Header.TIME
+            header.hdrtype = control
             
             hdr = Header(channel=header.channel, time=header.delta if control in (Header.MESSAGE, Header.TIME) else header.time, size=header.size, type=header.type, streamId=header.streamId)
             assert message.size == len(message.data)
 
-            data = ''
+            data, chunkSize = '', message.type == Message.CHUNK_SIZE and struct.unpack('>L', message.data)[0]
             while len(message.data) > 0:
                 data += hdr.toBytes(control) # gather header bytes
                 count = min(self.writeChunkSize, len(message.data))
@@ -259,10 +293,12 @@ class FlashClient(object):
                 control = Header.SEPARATOR # incomplete message continuation
             if data:
                 self.send(data)
+            if chunkSize: # applies to the next chunk
+                self.writeChunkSize = chunkSize
                 
     def protocolMessage(self, msg):
         if msg.type == Message.ACK: # update write window size
-            self.writeWinSize0 = struct.unpack('>L', msg.data)[0]
+            self.writeWinSize0, self.acked = struct.unpack('>L', msg.data)[0], True
         elif msg.type == Message.CHUNK_SIZE: # update read chunk size
             self.readChunkSize = struct.unpack('>L', msg.data)[0]
         elif msg.type == Message.WIN_ACK_SIZE: # update read window size
@@ -271,6 +307,7 @@ class FlashClient(object):
             type, data = struct.unpack('>H', msg.data[:2])[0], msg.data[2:]
             if type == 3: # client expects a response when it sends set buffer length
                 streamId, bufferTime = struct.unpack('>II', data)
+                self.bufferTimes[streamId] = bufferTime
                 response = Message()
                 response.time, response.type, response.data = self.relativeTime, Message.USER_CONTROL, struct.pack('>HI', 0, streamId)
                 self.writeMessage(response)
@@ -389,6 +426,12 @@ class FlashClient(object):
         if self.path in self.server.clients: inst = self.server.clients[self.path][0]
         else: inst = app()
         
+        chunkSize = inst.chunkSize or self.server.chunkSize
+        if chunkSize != self.writeChunkSize: # so that the connect response and the following messages use fewer chunks
+            set_chunk_size = Message()
+            set_chunk_size.time, set_chunk_size.type, set_chunk_size.data = self.relativeTime, Message.CHUNK_SIZE, struct.pack('>L', chunkSize)
+            self.writeMessage(set_chunk_size)
+        
         win_ack = Message()
         win_ack.time, win_ack.type, win_ack.data = self.relativeTime, Message.WIN_ACK_SIZE, struct.pack('>L', self.writeWinSize)
         self.writeMessage(win_ack)
@@ -517,13 +560,6 @@ class FlashClient(object):
             if _debug: print 'playing stream=', name, 'start=', start
             inst.onPlay(self, stream)
 
-            # Default chunk size is 128. It is pretty small when we stream high audio and video quality.
-            # So, send the choosen chunk size to flash client.
-            self.writeChunkSize = self.HIGH_WRITE_CHUNK_SIZE
-            m0 = Message() # SetChunkSize
-            m0.time, m0.type, m0.data = self.relativeTime, Message.CHUNK_SIZE, struct.pack('>L', self.writeChunkSize)
-            self.writeMessage(m0)
-            
 #            m1 = Message() # UserControl/StreamIsRecorded
 #            m1.time, m1.type, m1.data = self.relativeTime, Message.USER_CONTROL, struct.pack('>HI', 4, stream.id)
 #            self.writeMessage(m1)
@@ -579,41 +615,30 @@ class FLV(baseFLV):
         '''A gevent task that periodically reads the file and sends media in the stream to this client.'''
         if _debug: print 'reader started'
         try:
-            while self.fp is not None:
-                bytes = self.fp.read(11)
-                if len(bytes) == 0:
+            while self.file is not None:
+                if self.started is None: self.started = (time.time(), self.tsp) # after open or seek
+                until = self.tsp + self.PACING_WINDOW
+                tags, eof = self.readTags(until)
+                if stream is None or stream.client is None: break # if it is closed
+                if eof:
                     response = Command(name='onStatus', id=stream.id, tm=client.relativeTime, args=[amf.Object(level='status',code='NetStream.Play.Stop', description='File ended', details=None)])
                     client.writeMessage(response.toMessage(), stream)
                     break
-                type, len0, len1, ts0, ts1, ts2, sid0, sid1 = struct.unpack('>BBHBHBBH', bytes)
-                length = (len0 << 16) | len1; ts = (ts0 << 16) | (ts1 & 0x0ffff) | (ts2 << 24)
-                body = self.fp.read(length); ptagsize, = struct.unpack('>I', self.fp.read(4))
-                if ptagsize != (length+11): 
-                    if _debug: print 'invalid previous tag-size found:', ptagsize, '!=', (length+11),'ignored.'
-                if stream is None or stream.client is None: break # if it is closed
-                #hdr = Header(3 if type == Message.AUDIO else 4, ts if ts < 0xffffff else 0xffffff, length, type, stream.id)
-                hdr = Header(0, ts, length, type, stream.id)
-                msg = Message(hdr, body)
-                # if _debug: print 'FLV.read() length=', length, 'hdr=', hdr
-                # if hdr.type == Message.AUDIO: print 'r', hdr.type, hdr.time
-                if type == Message.DATA: # metadata
-                    amfReader = amf.AMF0(body) # TODO: use AMF3 if needed
-                    name = amfReader.read()
-                    obj = amfReader.read()
-                    if _debug: print 'FLV.read()', name, repr(obj)
-                client.writeMessage(msg, stream)
-                if ts > self.tsp: 
-                    diff, self.tsp = ts - self.tsp, ts
+                for type, ts, body in tags:
+                    if type == Message.DATA and _debug: print 'FLV.read()', self.metaData(body)
+                    client.writeMessage(Message(Header(0, ts, len(body), type, stream.id), body), stream)
+                self.tsp = max([until, self.tsp] + [x[1] for x in tags]) # next read is after the window, or after a later tag already sent
+                diff = self.delay(client, stream.id)
+                if diff > 0:
                     if _debug: print 'FLV.read() sleep', diff
-                    gevent.sleep(diff / 1000.0)
+                    gevent.sleep(diff)
+                else:
+                    gevent.sleep(0) # let other greenlets run during the fast start
         except gevent.GreenletExit:
             if _debug: print 'closing the reader'
         except: 
             if _debug: print 'closing the reader', (sys and sys.exc_info() or None)
-        if self.fp is not None: 
-            try: self.fp.close()
-            except: pass
-            self.fp = None
+        self.close()
             
 
 class Timer(object):
@@ -1468,7 +1493,7 @@ class FlashServer(StreamServer):
             except: pass
     
         StreamServer.__init__(self, (options.host, options.port), handle)
-        self.int_ip, self.ext_ip, self.root = options.int_ip, options.ext_ip, options.root
+        self.int_ip, self.ext_ip, self.root, self.chunkSize = options.int_ip, options.ext_ip, options.root, options.chunk_size
         self.apps, self.clients = dict({'*': App, 'sip': Gateway if sip else App, 'wirecast': Wirecast}), dict()
 
 
@@ -1479,6 +1504,7 @@ if __name__ == '__main__':
     parser.add_option('-i', '--host',    dest='host',    default='0.0.0.0', help="listening IP address for RTMP. Default '0.0.0.0'")
     parser.add_option('-p', '--port',    dest='port',    default=1935, type="int", help='listening port number for RTMP. Default 1935')
     parser.add_option('-r', '--root',    dest='root',    default='./',       help="document path prefix. Directory must end with /. Default './'")
+    parser.add_option('-k', '--chunk-size', dest='chunk_size', default=FlashClient.HIGH_WRITE_CHUNK_SIZE, type="int", help='RTMP chunk size of the messages sent to Flash Player, which is set right after connect. Default %d'%(FlashClient.HIGH_WRITE_CHUNK_SIZE,))
     parser.add_option('-l', '--int-ip',  dest='int_ip',  default='0.0.0.0', help="listening IP address for SIP and RTP. Default '0.0.0.0'")
     parser.add_option('-e', '--ext-ip',  dest='ext_ip',  default=None,      help='IP address to advertise in SIP/SDP. Default is to use "--int-ip" or any local interface')
     parser.add_option('-f', '--fork',    dest='fork',    default=1, type="int", help='Number of processes to use for concurrency. Default is 1.')